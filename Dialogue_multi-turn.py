@@ -11,16 +11,23 @@ Recreates a multi-session, multi-turn role-play setup:
 
 """
 
+import asyncio
+import hashlib
 import json
 import os
 import random
+import sqlite3
+import time
+import numpy as np
+import orjson
 from collections import Counter
 from datetime import datetime
-from typing import TypedDict, List, Literal, Dict, Any
+from typing import TypedDict, List, Literal, Dict, Any, Optional, Callable
 
 from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type
 
 # Load environment variables (OPENAI_API_KEY)
 load_dotenv()
@@ -28,13 +35,39 @@ load_dotenv()
 # Initialize OpenAI Client
 # NOTE: Using environment variables for security.
 # Ensure OPENAI_API_KEY is set in your .env file.
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Model Configuration
 MODEL_PATIENT = "gpt-4o"
 MODEL_THERAPIST = "gpt-4o"
+TOKENIZER_ENCODING = "o200k_base"  # gpt-4o tokenizer
 # Updated to valid model name format if needed
 
+# Profile summaries are cached in a SQLite database by SHA-256 of the profile text,
+# so re-runs skip the LLM call. With SUMMARY_SEMANTIC_CACHE=1, each row also keeps
+# the profile's embedding, and a new profile whose embedding is near-identical
+# (cosine similarity at or above the threshold) to a cached one, e.g. a paraphrase,
+# reuses that profile's summary. It is opt-in: synthetic profiles share one
+# template, so two different patients can pass the threshold, and the second
+# would get the first one's clinical summary
+SUMMARY_CACHE_DB = os.path.join(".cache", "profile_summaries.db")
+SUMMARY_SEMANTIC_CACHE = os.getenv("SUMMARY_SEMANTIC_CACHE", "0") == "1"
+EMBEDDING_MODEL = "text-embedding-3-small"
+SUMMARY_SIMILARITY_THRESHOLD = 0.95
+EMBEDDING_MAX_CHARS = 24000  # ~6k tokens, safely under the embedding model's 8k input limit
+
+# Set LLM_CACHE_ENABLED=1 to answer byte-identical requests (same model, prompts,
+# output cap, format and stop sequences) from a SQLite cache, so re-running or
+# resuming a batch replays earlier responses for free. No request sets a
+# temperature, so a cached response is one valid sample at the default setting,
+# but replays repeat it instead of drawing a new one
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "0") == "1"
+LLM_CACHE_DB = os.path.join(".cache", "llm_responses.db")
+
+# Prompt tokens sent and the part of them served from OpenAI's prompt cache,
+# summed over every response that reports usage
+prompt_token_usage = Counter()
+
 
 # Therapeutic Strategies Catalogs
 
@@ -557,6 +590,45 @@ ENVIRONMENT_STRESSORS = [
 
 ]
 
+
+def _stressor_lifetime(duration: str) -> Optional[int]:
+    """
+    Returns how many sessions a stressor with the given "Likely Duration" stays in
+    the patient's stressor ledger, or None if it is never removed.
+    """
+    duration = duration.lower()
+    # Handle cases like "Days–Weeks" by checking for specific keywords.
+    if "minute" in duration or "hour" in duration or "day" in duration and "week" not in duration and "month" not in duration:
+        return 1
+    if "week" in duration and "month" not in duration:
+        return 3
+    # Stressors with "Months" duration (or no recognizable duration) are not removed
+    return None
+
+
+# Column views of ENVIRONMENT_STRESSORS, built once at import. The environment
+# node samples row indices and reads a stressor's precomputed lifetime by index
+# instead of re-parsing its duration text every session.
+_STRESSOR_CATEGORIES = tuple(s["Category"] for s in ENVIRONMENT_STRESSORS)
+_STRESSOR_NAMES = tuple(s["Stressor"] for s in ENVIRONMENT_STRESSORS)
+_STRESSOR_DESCS = tuple(s["Description"] for s in ENVIRONMENT_STRESSORS)
+_STRESSOR_SEVERITIES = tuple(s["Severity"] for s in ENVIRONMENT_STRESSORS)
+_STRESSOR_DURATIONS = tuple(s["Likely Duration"] for s in ENVIRONMENT_STRESSORS)
+_STRESSOR_LIFETIMES = tuple(_stressor_lifetime(d) for d in _STRESSOR_DURATIONS)
+
+
+def _stressor_row(index: int) -> Dict[str, Any]:
+    """Builds the ledger entry for row `index` of the stressor columns."""
+    return {
+        "Category": _STRESSOR_CATEGORIES[index],
+        "Stressor": _STRESSOR_NAMES[index],
+        "Description": _STRESSOR_DESCS[index],
+        "Severity": _STRESSOR_SEVERITIES[index],
+        "Likely Duration": _STRESSOR_DURATIONS[index],
+        "stressor_index": index,
+    }
+
+
 def clamp(value, min_value, max_value):
     """Clamps a value between a minimum and maximum."""
     return max(min_value, min(value, max_value))
@@ -618,7 +690,8 @@ class PatientMemory:
     def apply_stressors(self, stressors: List[Dict[str, Any]], session_number: int):
         """Applies a list of stressors to the patient's memory."""
         for stressor in stressors:
-            stressor["session_added"] = session_number
+            # Copy so the shared ENVIRONMENT_STRESSORS entries are never mutated
+            stressor = {**stressor, "session_added": session_number}
             self.stressor_ledger.append(stressor)
             category = stressor.get("Category", "")
             if category == "Social/Environmental":
@@ -651,6 +724,7 @@ class DialogueState(TypedDict):
 
     Attributes:
         history: List of interaction dictionaries (role/content).
+        history_text: history rendered as a plain-text transcript for prompting, extended one line per turn.
         patient_profile: String representation of the patient.
         patient_profile_summary: A concise summary of the patient profile.
         difficulty: The set difficulty level (easy/medium/hard).
@@ -658,13 +732,16 @@ class DialogueState(TypedDict):
         max_turns: Target total turns.
         turn_index: Current 0-based turn count.
         strategy_history: List of strategy IDs used so far.
+        strategy_counts: Running count of each strategy in strategy_history.
+        strategy_usage_text: strategy_counts formatted for the therapist prompt.
         patient_resolution_status: Boolean indicating if the patient has achieved resolution.
-        patient_state_summary: A summary of the patient's state.
         session_number: The current session number (1-6).
+        session_prefix: Therapist prompt prefix that is fixed for the session.
         patient_memory: 'PatientMemory'
     """
 
     history: List[Dict[str, str]]
+    history_text: str
     patient_profile: str
     patient_profile_summary: str
     difficulty: Literal["easy", "medium", "hard"]
@@ -672,9 +749,11 @@ class DialogueState(TypedDict):
     max_turns: int
     turn_index: int
     strategy_history: List[str]
+    strategy_counts: Counter
+    strategy_usage_text: str
     patient_resolution_status: bool
-    patient_state_summary: str
     session_number: int
+    session_prefix: str
 
 
 DIFFICULTY_DESCRIPTIONS = {
@@ -723,39 +802,339 @@ SESSION_GOALS = {
 }
 
 
-def summarize_patient_profile(profile: str) -> str:
+# Strategy subsets injected into the therapist prompt per session, aligned with
+# SESSION_GOALS. Functional analysis stays in every session because each
+# session agenda includes an episode clarification step.
+SESSION_STRATEGY_SUBSET = {
+    1: {
+        "mi": ["mi_scales", "mi_agenda", "mi_ep_e"],
+        "cbt": ["cbt_functional_analysis", "cbt_trigger_mapping"],
+        "act": ["act_psychoeducation", "act_journaling", "act_crisis_plan", "act_routine"],
+    },
+    2: {
+        "mi": ["mi_values", "mi_agenda", "mi_scales"],
+        "cbt": ["cbt_functional_analysis", "cbt_trigger_mapping", "cbt_reappraisal"],
+        "act": ["act_emotional_triggers", "act_journaling", "act_mindfulness", "act_psychoeducation"],
+    },
+    3: {
+        "mi": ["mi_decisional_balance", "mi_values", "mi_ep_e"],
+        "cbt": ["cbt_functional_analysis", "cbt_reappraisal", "cbt_coping_skills"],
+        "act": ["act_emotional_triggers", "act_mindfulness", "act_grounding", "act_strengths"],
+    },
+    4: {
+        "mi": ["mi_scales", "mi_decisional_balance", "mi_ep_e"],
+        "cbt": [
+            "cbt_functional_analysis", "cbt_reappraisal", "cbt_problem_solving",
+            "cbt_goal_setting", "cbt_refusal",
+        ],
+        "act": ["act_goals", "act_assertive_comm", "act_routine", "act_strengths"],
+    },
+    5: {
+        "mi": ["mi_scales", "mi_ep_e"],
+        "cbt": [
+            "cbt_functional_analysis", "cbt_coping_skills", "cbt_refusal", "cbt_stimulus_control",
+            "cbt_exposure", "cbt_problem_solving", "cbt_behavioral_activation",
+        ],
+        "act": [
+            "act_crisis_plan", "act_grounding", "act_relaxation", "act_routine",
+            "act_hobbies", "act_assertive_comm", "act_health",
+        ],
+    },
+    6: {
+        "mi": ["mi_scales", "mi_values"],
+        "cbt": ["cbt_functional_analysis", "cbt_goal_setting", "cbt_coping_skills", "cbt_behavioral_activation"],
+        "act": [
+            "act_support_group", "act_community", "act_strengths", "act_vision_board",
+            "act_gratitude", "act_goals", "act_complementary_therapy",
+        ],
+    },
+}
+
+
+def get_session_strategies(strategy_list: List[Dict[str, str]], session_number: int, catalog: str) -> List[Dict[str, str]]:
+    """
+    Returns the strategies from a catalog ("mi", "cbt" or "act") that are relevant
+    to the given session. Sessions without a subset get the full catalog.
+    """
+    subset = SESSION_STRATEGY_SUBSET.get(session_number)
+    if subset is None:
+        return strategy_list
+    allowed_ids = set(subset[catalog])
+    return [s for s in strategy_list if s["id"] in allowed_ids]
+
+
+class ProfileSummaryCache:
+    """
+    Profile summaries persisted in SQLite (WAL mode), looked up by the SHA-256 of
+    the profile text or, failing that, by cosine similarity of the profile's
+    L2-normalized embedding against every cached profile.
+    All rows are held in memory; there is one row per distinct profile, so a
+    NumPy dot product over the matrix of embeddings is enough for the search.
+    """
+
+    def __init__(self, path: str, threshold: float):
+        self.threshold = threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "key TEXT PRIMARY KEY, embedding BLOB, summary TEXT, created_at INTEGER)"
+        )
+        self.summaries: Dict[str, str] = {}
+        self.embedded_summaries: List[str] = []
+        embeddings = []
+        for key, embedding, summary in self.conn.execute("SELECT key, embedding, summary FROM summaries"):
+            self.summaries[key] = summary
+            if embedding is not None:
+                embeddings.append(np.frombuffer(embedding, dtype=np.float32))
+                self.embedded_summaries.append(summary)
+        self.matrix = np.vstack(embeddings) if embeddings else None
+
+    def get(self, key: str) -> Optional[str]:
+        summary = self.summaries.get(key)
+        if summary is not None:
+            self.exact_hits += 1
+        return summary
+
+    def nearest(self, embedding: np.ndarray) -> Optional[str]:
+        if self.matrix is None:
+            return None
+        similarities = self.matrix @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            self.semantic_hits += 1
+            print(f"Reusing the summary of a similar cached profile (similarity {similarities[best]:.3f}).")
+            return self.embedded_summaries[best]
+        return None
+
+    def add(self, key: str, embedding: Optional[np.ndarray], summary: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO summaries (key, embedding, summary, created_at) VALUES (?, ?, ?, ?)",
+            (key, embedding.tobytes() if embedding is not None else None, summary, int(time.time())),
+        )
+        self.conn.commit()
+        self.summaries[key] = summary
+        if embedding is not None:
+            row = embedding.reshape(1, -1)
+            self.matrix = row if self.matrix is None else np.vstack([self.matrix, row])
+            self.embedded_summaries.append(summary)
+
+
+summary_cache = ProfileSummaryCache(SUMMARY_CACHE_DB, SUMMARY_SIMILARITY_THRESHOLD)
+
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(1, 30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    reraise=True,
+)
+async def _request_embedding(text: str) -> np.ndarray:
+    """Returns the L2-normalized float32 embedding of text, retrying transient failures."""
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text[:EMBEDDING_MAX_CHARS])
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+async def summarize_patient_profile(profile: str) -> str:
     """
     Uses an LLM to create a concise summary of the patient profile.
+    Summaries are cached in summary_cache by exact profile text and, with
+    SUMMARY_SEMANTIC_CACHE set, by embedding similarity, so paraphrased
+    profiles share one summary.
     """
+    key = hashlib.sha256(profile.encode("utf-8")).hexdigest()
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return cached
+
+    embedding = None
+    if SUMMARY_SEMANTIC_CACHE:
+        try:
+            embedding = await _request_embedding(profile)
+        except Exception as e:
+            print(f"Embedding failed, skipping the semantic summary cache: {e}")
+        if embedding is not None:
+            cached = summary_cache.nearest(embedding)
+            if cached is not None:
+                # Not stored under this profile's key, so a run with the
+                # semantic cache off still summarizes it on its own
+                return cached
+
     instructions = (
         "Summarize the following patient profile into a concise paragraph. "
         "Focus on the key clinical details: primary issue, substance use history, "
         "behavioral patterns, barriers and motivations. This summary will be used by a therapist bot "
         "to maintain context during a conversation."
     )
-    summary = call_llm(
+    summary = await call_llm(
         model=MODEL_THERAPIST,
         instructions=instructions,
         input_text=profile,
         max_output_tokens=256,
     )
+
+    # Don't persist the placeholder returned for a failed call
+    if not summary.startswith("[API_FAILURE"):
+        summary_cache.add(key, embedding, summary)
     return summary
 
 
-def call_llm(model: str, instructions: str, input_text: str, max_output_tokens: int = 256) -> str:
+class LLMResponseCache:
     """
-    Thin wrapper around the OpenAI Chat Completions API with error handling.
+    LLM responses persisted in SQLite (WAL mode), keyed by the SHA-256 of the
+    request's canonical JSON.
     """
-    try:
-        response = client.chat.completions.create(
+
+    def __init__(self, path: str):
+        self.hits = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT, created_at INTEGER)"
+        )
+
+    @staticmethod
+    def request_key(request: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, response: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, response, created_at) VALUES (?, ?, ?)",
+            (key, response, int(time.time())),
+        )
+        self.conn.commit()
+
+
+llm_cache = LLMResponseCache(LLM_CACHE_DB) if LLM_CACHE_ENABLED else None
+
+
+def _record_prompt_usage(usage: Any):
+    """Adds a response's prompt and cached token counts to prompt_token_usage."""
+    if usage is None:
+        return
+    prompt_token_usage["prompt_tokens"] += usage.prompt_tokens or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    prompt_token_usage["cached_tokens"] += (getattr(details, "cached_tokens", None) or 0)
+
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(1, 30),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    reraise=True,
+)
+async def _request_completion(
+    model: str,
+    messages: List[Dict[str, str]],
+    max_output_tokens: int,
+    response_format: Optional[Dict[str, Any]] = None,
+    stop: Optional[List[str]] = None,
+    stream_until: Optional[Callable[[str], bool]] = None,
+    prompt_cache_key: Optional[str] = None,
+) -> str:
+    """
+    Sends a single Chat Completions request, retrying transient failures
+    (rate limits, dropped connections, timeouts) with exponential backoff.
+    If `stream_until` is given, the response is streamed and the stream is
+    closed as soon as stream_until(text_so_far) is true, so generation stops early.
+    """
+    request_kwargs = {}
+    if response_format is not None:
+        request_kwargs["response_format"] = response_format
+    if stop:
+        request_kwargs["stop"] = stop
+    if prompt_cache_key:
+        request_kwargs["prompt_cache_key"] = prompt_cache_key
+
+    if stream_until is None:
+        response = await client.chat.completions.create(
             model=model,
-            messages=[
-                {"role": "system", "content": instructions},
-                {"role": "user", "content": input_text},
-            ],
+            messages=messages,
             max_tokens=max_output_tokens,
+            **request_kwargs,
         )
+        _record_prompt_usage(response.usage)
         return response.choices[0].message.content.strip()
+
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_output_tokens,
+        stream=True,
+        stream_options={"include_usage": True},
+        **request_kwargs,
+    )
+    text = ""
+    try:
+        async for chunk in stream:
+            # Usage arrives in a final chunk, so streams closed early don't report it
+            _record_prompt_usage(getattr(chunk, "usage", None))
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                if stream_until(text):
+                    break
+    finally:
+        await stream.close()
+    return text.strip()
+
+
+async def call_llm(
+    model: str,
+    instructions: str,
+    input_text: str,
+    max_output_tokens: int = 256,
+    response_format: Optional[Dict[str, Any]] = None,
+    stop: Optional[List[str]] = None,
+    stream_until: Optional[Callable[[str], bool]] = None,
+    static_instructions: Optional[str] = None,
+    prompt_cache_key: Optional[str] = None,
+) -> str:
+    """
+    Thin wrapper around the OpenAI Chat Completions API with error handling.
+    Transient errors are retried in _request_completion; only errors that
+    survive all retries (or are not retryable) fall through to the placeholder.
+    `static_instructions`, if given, is sent as a first system message ahead of
+    `instructions`, so a prompt part shared by many requests stays a stable prefix.
+    """
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": input_text}]
+    if static_instructions:
+        messages.insert(0, {"role": "system", "content": static_instructions})
+
+    cache_key = None
+    if llm_cache is not None:
+        cache_key = llm_cache.request_key({
+            "m": model, "s": static_instructions, "i": instructions, "u": input_text,
+            "t": max_output_tokens, "f": response_format, "p": stop,
+        })
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    try:
+        response = await _request_completion(
+            model=model,
+            messages=messages,
+            max_output_tokens=max_output_tokens,
+            response_format=response_format,
+            stop=stop,
+            stream_until=stream_until,
+            prompt_cache_key=prompt_cache_key,
+        )
+        if cache_key is not None:
+            llm_cache.put(cache_key, response)
+        return response
     except Exception as e:
         # Print the error and return a placeholder message
         print(f"\n--- ERROR DURING API CALL ---")
@@ -778,22 +1157,55 @@ def render_history_for_prompt(history: List[Dict[str, str]]) -> str:
     return "\n".join(lines)
 
 
+def append_history_text(history_text: str, role: str, content: str) -> str:
+    """
+    Appends one message to a transcript rendered by render_history_for_prompt,
+    so the transcript grows with each turn instead of being rebuilt.
+    """
+    line = f"{'Patient' if role == 'patient' else 'Therapist'}: {content}"
+    return f"{history_text}\n{line}" if history_text else line
+
+
 # Patient Node Logic
 
 
-def patient_node(state: DialogueState) -> Dict[str, Any]:
+def _format_stressor_text(state: DialogueState) -> str:
+    """Formats the stressors recorded since the last session for the patient prompt."""
+    stressors = state.get("patient_memory").stressor_ledger if state.get("patient_memory") else []
+    if not stressors:
+        return ""
+    stressor_items = [f"- {s['Description']} ({s['Stressor']})" for s in stressors]
+    return "RECENT STRESSFUL EVENTS (since last session):\n" + "\n".join(stressor_items) + "\n"
+
+
+# The patient reply is constrained to this schema, so the response is always a
+# bare JSON object (no markdown fences) with both fields present
+PATIENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "patient_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "reply": {"type": "string"},
+                "resolution_status": {"type": "boolean"},
+            },
+            "required": ["reply", "resolution_status"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+async def patient_node(state: DialogueState) -> Dict[str, Any]:
     """
-    Generates the patient's next utterance, summary, and resolution status in a single call.
+    Generates the patient's next utterance and resolution status in a single call.
     """
-    history_text = render_history_for_prompt(state["history"])
+    history_text = state["history_text"]
     display_history = history_text if history_text else "(no prior conversation – this is the first turn)"
 
-    # Format stressors for the prompt
-    stressors = state.get("patient_memory").stressor_ledger if state.get("patient_memory") else []
-    stressor_text = ""
-    if stressors:
-        stressor_items = [f"- {s['Description']} ({s['Stressor']})" for s in stressors]
-        stressor_text = "RECENT STRESSFUL EVENTS (since last session):\n" + "\n".join(stressor_items) + "\n"
+    stressor_text = _format_stressor_text(state)
 
     instructions_for_json_output = """
 You are role-playing as a patient in addiction recovery.
@@ -801,11 +1213,10 @@ Speak from the profile below, staying consistent with the conversation so far.
 Your difficulty level description explains how resistant or ambivalent you are to therapist's suggestions. 
 At the beginning of each session, report important events since last session. If there were stressful events (stressors) or supportive events since the last session, you MUST incorporate them into your reply.
 
-Your task is to generate a single JSON object containing three fields: "reply", "summary", and "resolution_status".
+Your task is to generate a single JSON object containing two fields: "reply" and "resolution_status".
 
 1.  **reply**: Create the patient's next utterance based on the conversation history and their profile. This should be a natural, brief response in the patient's voice. Do not include narration or system messages.
-2.  **summary**: Analyze the patient's message and the current situation to provide a compact summary of their state. This summary should cover aspects like craving levels, trigger salience, confidence, and any flags for recent lapses.
-3.  **resolution_status**: Analyze the patient's message for indications that the session is complete. If the patient expresses sufficient motivation, confidence, and commitment to try a therapy micro-assignment, AND uses language that signals closure or readiness to end the dialogue (e.g., 'See you next time', 'I think we’ve covered everything', 'That helped a lot'), set this to `true`. Otherwise, set it to `false`.
+2.  **resolution_status**: Analyze the patient's message for indications that the session is complete. If the patient expresses sufficient motivation, confidence, and commitment to try a therapy micro-assignment, AND uses language that signals closure or readiness to end the dialogue (e.g., 'See you next time', 'I think we’ve covered everything', 'That helped a lot'), set this to `true`. Otherwise, set it to `false`.
 
 The final output MUST be a valid JSON object and nothing else.
 """
@@ -821,24 +1232,21 @@ Difficulty Setting:
 Conversation So Far:
 {display_history}
 
-Based on the above, provide the next patient turn as a JSON object with "reply", "summary", and "resolution_status".
+Based on the above, provide the next patient turn as a JSON object with "reply" and "resolution_status".
 """
 
-    response_str = call_llm(
+    response_str = await call_llm(
         model=MODEL_PATIENT,
         instructions=instructions_for_json_output,
         input_text=prompt,
-        max_output_tokens=256,  # Increased to accommodate JSON structure and content
+        max_output_tokens=128,  # A brief reply plus the resolution flag
+        response_format=PATIENT_RESPONSE_FORMAT,
     )
 
     try:
-        # The response might be enclosed in markdown ```json ... ```
-        if response_str.startswith("```json"):
-            response_str = response_str[7:-4]
-
+        # The schema guarantees valid JSON; this only guards against failed calls
         response_data = json.loads(response_str)
         patient_reply = response_data.get("reply", "[MISSING_REPLY]")
-        patient_state_summary = response_data.get("summary", "[MISSING_SUMMARY]")
         patient_resolution_status = response_data.get("resolution_status", False)
     except (json.JSONDecodeError, AttributeError) as e:
         print(f"--- ERROR PARSING PATIENT JSON RESPONSE ---")
@@ -846,7 +1254,6 @@ Based on the above, provide the next patient turn as a JSON object with "reply",
         print(f"Raw response: {response_str}")
         # Provide fallback values to avoid crashing the graph
         patient_reply = response_str  # Use the raw string as a fallback for the reply
-        patient_state_summary = "Error parsing patient state."
         patient_resolution_status = False
 
     new_history = state["history"] + [{"role": "patient", "content": patient_reply}]
@@ -854,8 +1261,8 @@ Based on the above, provide the next patient turn as a JSON object with "reply",
 
     return {
         "history": new_history,
+        "history_text": append_history_text(state["history_text"], "patient", patient_reply),
         "turn_index": new_turn_index,
-        "patient_state_summary": patient_state_summary,
         "patient_resolution_status": patient_resolution_status,
     }
 
@@ -884,58 +1291,42 @@ rehearsal with a specific peer, a stimulus-control action (remove a procurement
     return agenda
 
 
-def therapist_node(state: DialogueState) -> Dict[str, Any]:
-    """
-    Generates the therapist's response using a summarized profile and strategy names to save tokens.
-    """
-    if "patient_memory" not in state:
-        state["patient_memory"] = PatientMemory()
+def get_strategy_names(strategy_list: List[Dict[str, str]]) -> str:
+    """Formats a strategy catalog as a comma-separated list of quoted names."""
+    return ", ".join([f'"{item["name"]}"' for item in strategy_list])
 
-    history_text = render_history_for_prompt(state["history"])
-
-    # Track strategy usage
-    strategy_counts = Counter(state["strategy_history"])
-    strategy_usage_text = "\n".join(
-        [f"- {strategy}: {count} times used." for strategy, count in strategy_counts.items()]
-    )
-    if not strategy_usage_text:
-        strategy_usage_text = "No strategies used yet."
 
-    def get_strategy_names(strategy_list: List[Dict[str, str]]) -> str:
-        return ", ".join([f'"{item["name"]}"' for item in strategy_list])
+# The catalogs are constants, so their name lists are formatted once at import:
+# in full for sessions without a subset, and per session for the rest
+MI_NAMES_STR = get_strategy_names(MI_STRATEGIES)
+CBT_NAMES_STR = get_strategy_names(CBT_STRATEGIES)
+ACT_NAMES_STR = get_strategy_names(ACTIONABLE_TOOLS)
+FULL_STRATEGY_NAMES = {"mi": MI_NAMES_STR, "cbt": CBT_NAMES_STR, "act": ACT_NAMES_STR}
+SESSION_STRATEGY_NAMES = {
+    session_number: {
+        "mi": get_strategy_names(get_session_strategies(MI_STRATEGIES, session_number, "mi")),
+        "cbt": get_strategy_names(get_session_strategies(CBT_STRATEGIES, session_number, "cbt")),
+        "act": get_strategy_names(get_session_strategies(ACTIONABLE_TOOLS, session_number, "act")),
+    }
+    for session_number in SESSION_STRATEGY_SUBSET
+}
 
-    # Get the session-specific goals and agenda
-    session_number = state["session_number"]
-    session_goal = SESSION_GOALS.get(session_number, {})
-    cbt_goal = session_goal.get("cbt_stage_goal", "N/A")
-    mi_focus = session_goal.get("mi_focus", "N/A")
-    session_agenda = _get_session_agenda(session_number)
 
-    therapist_instructions_template = """
+# The therapist prompt is split in three: a static block that is identical for
+# every patient and session, a prefix that is fixed for the whole session
+# (formatted once per session) and a short tail that changes every turn.
+# The static block goes first in its own system message, followed by the
+# session-wide parts that are shared by every course (goals, strategies, agenda)
+# and only then the patient's own summary and state. OpenAI's automatic prompt
+# caching matches on the longest byte-identical prefix, so this order lets the
+# shared parts be reused across courses, not only across turns of one session.
+THERAPIST_STATIC_PROMPT = """
 You are a licensed therapist in a role-play simulation conducting an ongoing course of therapy with a patient who has alcohol addiction. 
 Your goal is to create a detailed, step-by-step conversation with a patient based on their profile and current state that incorporates 
-AVAILABLE STRATEGIES below.
+the AVAILABLE STRATEGIES listed for the session.
 
 You should be empathetic, non-judgmental, and collaborative.
 
-PATIENT SUMMARY:
-{user_analysis}
-
-PATIENT'S CURRENT STATE:
-{patient_state}
-
-SESSION {session_number}:
-- CBT Goal: {cbt_goal}
-- MI Focus: {mi_focus}
-
-STRATEGY USAGE:
-{strategy_usage}
-
-AVAILABLE STRATEGIES:
-- MI Strategies: {MI_STRATEGIES}
-- CBT Strategies: {CBT_STRATEGIES}
-- Actionable Tools: {ACTIONABLE_TOOLS}
-
 INSTRUCTIONS:
 1. Read the patient summary and conversation history carefully.
 2. Follow the session agenda provided below as an internal guide. Do not mention the agenda items (e.g., "Functional Analysis," "Actionable Step") in your response.
@@ -968,42 +1359,170 @@ it during specific times of day or situations?
 After your response, you MUST list the strategies you used on a new line. Use the format:
 **Strategies:** Strategy Name 1, Strategy Name 2
 
-CONVERSATION SO FAR:
-{history_text}
+"""
+
+THERAPIST_SESSION_TEMPLATE = """
+SESSION {session_number}:
+- CBT Goal: {cbt_goal}
+- MI Focus: {mi_focus}
+
+AVAILABLE STRATEGIES:
+- MI Strategies: {MI_STRATEGIES}
+- CBT Strategies: {CBT_STRATEGIES}
+- Actionable Tools: {ACTIONABLE_TOOLS}
 
 SESSION AGENDA:
 {session_agenda}
+PATIENT SUMMARY:
+{user_analysis}
+
+PATIENT'S CURRENT STATE:
+{patient_state}
 """
 
-    therapist_instructions = therapist_instructions_template.format(
-        user_analysis=state["patient_profile_summary"],
-        patient_state=state["patient_memory"].get_summary(),
+THERAPIST_TURN_TEMPLATE = """
+STRATEGY USAGE:
+{strategy_usage}
+
+CONVERSATION SO FAR:
+{history_text}
+"""
+
+
+def _render_session_block(session_number: int) -> str:
+    """
+    Formats THERAPIST_SESSION_TEMPLATE for a session, leaving only the
+    {user_analysis} and {patient_state} placeholders to fill per patient.
+    """
+    session_goal = SESSION_GOALS.get(session_number, {})
+    strategy_names = SESSION_STRATEGY_NAMES.get(session_number, FULL_STRATEGY_NAMES)
+    return THERAPIST_SESSION_TEMPLATE.format(
+        user_analysis="{user_analysis}",
+        patient_state="{patient_state}",
         session_number=session_number,
-        cbt_goal=cbt_goal,
-        mi_focus=mi_focus,
+        cbt_goal=session_goal.get("cbt_stage_goal", "N/A"),
+        mi_focus=session_goal.get("mi_focus", "N/A"),
+        MI_STRATEGIES=strategy_names["mi"],
+        CBT_STRATEGIES=strategy_names["cbt"],
+        ACTIONABLE_TOOLS=strategy_names["act"],
+        session_agenda=_get_session_agenda(session_number),
+    )
+
+
+# Session blocks are rendered once at import; a session prefix is then a single
+# two-field format of its block
+SESSION_PROMPT_BLOCKS = {session_number: _render_session_block(session_number) for session_number in SESSION_GOALS}
+
+
+def count_tokens(text: str) -> int:
+    """
+    Returns the TOKENIZER_ENCODING token count of text, or an estimate of ~4
+    characters per token if the tokenizer cannot be loaded.
+    """
+    try:
+        import tiktoken
+
+        return len(tiktoken.get_encoding(TOKENIZER_ENCODING).encode(text))
+    except Exception:
+        # The encoding is downloaded on first use and may be unavailable offline
+        return len(text) // 4
+
+
+# Token counts of the therapist prompt parts that are the same for every
+# course, counted once at import (the session blocks without their patient fields)
+THERAPIST_STATIC_PROMPT_TOKENS = count_tokens(THERAPIST_STATIC_PROMPT)
+SESSION_PROMPT_BLOCK_TOKENS = {
+    session_number: count_tokens(block.format(user_analysis="", patient_state=""))
+    for session_number, block in SESSION_PROMPT_BLOCKS.items()
+}
+
+
+def build_session_prefix(session_number: int, patient_profile_summary: str, patient_memory: PatientMemory) -> str:
+    """
+    Formats the part of the therapist prompt that stays fixed for a whole session.
+    It follows THERAPIST_STATIC_PROMPT, which is sent unchanged with every request.
+    """
+    block = SESSION_PROMPT_BLOCKS.get(session_number) or _render_session_block(session_number)
+    return block.format(
+        user_analysis=patient_profile_summary,
+        patient_state=patient_memory.get_summary(),
+    )
+
+
+# The therapist sometimes keeps writing the transcript after its own turn;
+# the server stops decoding at the next "Patient:" line.
+THERAPIST_STOP_SEQUENCES = ["\nPatient:"]
+
+
+def format_strategy_usage(strategy_counts: Counter) -> str:
+    """Formats strategy counts as the STRATEGY USAGE lines of the therapist prompt."""
+    if not strategy_counts:
+        return "No strategies used yet."
+    return "\n".join([f"- {strategy}: {count} times used." for strategy, count in strategy_counts.items()])
+
+
+def update_strategy_usage(state: DialogueState, strategies_used: List[str]) -> Dict[str, Any]:
+    """
+    Returns the strategy_counts and strategy_usage_text updates for a turn.
+    Counts are carried in the state and updated with the turn's strategies only,
+    instead of being recounted from the whole strategy_history every turn.
+    """
+    if not strategies_used:
+        return {"strategy_counts": state["strategy_counts"], "strategy_usage_text": state["strategy_usage_text"]}
+    strategy_counts = state["strategy_counts"].copy()
+    strategy_counts.update(strategies_used)
+    return {"strategy_counts": strategy_counts, "strategy_usage_text": format_strategy_usage(strategy_counts)}
+
+
+def _therapist_turn_complete(text: str) -> bool:
+    """
+    True once the streamed therapist turn contains a finished "**Strategies:**" line,
+    which is always the last part of the turn.
+    """
+    _, marker, strategies = text.partition("**Strategies:**")
+    return bool(marker) and "\n" in strategies
+
+
+async def therapist_node(state: DialogueState) -> Dict[str, Any]:
+    """
+    Generates the therapist's response using a summarized profile and strategy names to save tokens.
+    """
+    if "patient_memory" not in state:
+        state["patient_memory"] = PatientMemory()
+
+    history_text = state["history_text"]
+
+    # The session prefix is normally built once by the driver; fall back to
+    # building it here if the state was created without one.
+    session_prefix = state.get("session_prefix") or build_session_prefix(
+        state["session_number"], state["patient_profile_summary"], state["patient_memory"]
+    )
+
+    therapist_instructions = session_prefix + THERAPIST_TURN_TEMPLATE.format(
+        strategy_usage=state["strategy_usage_text"],
         history_text=history_text,
-        strategy_usage=strategy_usage_text,
-        MI_STRATEGIES=get_strategy_names(MI_STRATEGIES),
-        CBT_STRATEGIES=get_strategy_names(CBT_STRATEGIES),
-        ACTIONABLE_TOOLS=get_strategy_names(ACTIONABLE_TOOLS),
-        session_agenda=session_agenda,
     )
 
     # The user prompt is a trigger to generate the response based on the system prompt.
     therapist_prompt = "Therapist:"
 
-    full_response = call_llm(
+    full_response = await call_llm(
         model=MODEL_THERAPIST,
         instructions=therapist_instructions,
         input_text=therapist_prompt,
         max_output_tokens=512,
+        stop=THERAPIST_STOP_SEQUENCES,
+        stream_until=_therapist_turn_complete,
+        static_instructions=THERAPIST_STATIC_PROMPT,
+        prompt_cache_key=f"therapist-s{state['session_number']}",
     )
 
     # Parse the response to separate the dialogue from the strategies
     if "**Strategies:**" in full_response:
         parts = full_response.split("**Strategies:**")
         therapist_reply = parts[0].strip()
-        strategies_used_str = parts[1].strip()
+        # Only the strategies line itself; the last streamed chunk may run past it
+        strategies_used_str = parts[1].strip().split("\n", 1)[0]
         strategies_used = [s.strip() for s in strategies_used_str.split(",")]
     else:
         therapist_reply = full_response.strip()
@@ -1015,8 +1534,143 @@ SESSION AGENDA:
 
     return {
         "history": new_history,
+        "history_text": append_history_text(state["history_text"], "therapist", therapist_reply),
         "turn_index": new_turn_index,
         "strategy_history": new_strategy_history,
+        **update_strategy_usage(state, strategies_used),
+    }
+
+
+# Dual-Role Node Logic
+# With DUAL_ROLE=1, easy/medium sessions generate both sides of an exchange in
+# one structured-output call, halving round trips per turn pair. Hard patients
+# keep the separate patient/therapist calls so the patient voice stays
+# adversarial. It is off by default: the combined call changes the patient
+# voice in the generated data, so both paths should be compared before it is
+# relied on.
+
+USE_DUAL_ROLE = os.getenv("DUAL_ROLE", "0") == "1"
+DUAL_ROLE_DIFFICULTIES = {"easy", "medium"}
+
+DUAL_ROLE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "dialogue_turn_pair",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "therapist": {"type": "string"},
+                "strategies": {"type": "array", "items": {"type": "string"}},
+                "patient": {"type": "string"},
+                "resolution": {"type": "boolean"},
+            },
+            "required": ["therapist", "strategies", "patient", "resolution"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+DUAL_ROLE_TEMPLATE = """
+You are writing BOTH sides of the next exchange in a simulated therapy session: first the therapist's turn, then the patient's reply to it.
+
+=== THERAPIST ROLE ===
+Write the therapist's turn following the therapist instructions above and this session's details:
+{session_prefix}
+Instead of writing a "**Strategies:**" line, report the strategies you used in the "strategies" field.
+
+=== PATIENT ROLE ===
+The patient is in addiction recovery and speaks from the profile below, staying consistent with the conversation so far.
+The difficulty setting explains how resistant or ambivalent the patient is to the therapist's suggestions.
+At the beginning of each session the patient reports important events since the last session, including any stressful or supportive events listed below.
+
+Patient Profile:
+{patient_profile}
+
+Difficulty Setting:
+{difficulty_description}
+
+{stressor_text}
+=== OUTPUT ===
+Return a JSON object with:
+- "therapist": the therapist's next reply only, without labels or narration.
+- "strategies": the names of the strategies the therapist used.
+- "patient": the patient's natural, brief reply to that therapist turn, without narration.
+- "resolution": true only if the patient expresses sufficient motivation, confidence, and commitment to try a therapy micro-assignment AND signals closure or readiness to end the dialogue (e.g., 'See you next time', 'That helped a lot'); otherwise false.
+
+STRATEGY USAGE:
+{strategy_usage}
+
+CONVERSATION SO FAR:
+{history_text}
+"""
+
+
+async def dialogue_pair_node(state: DialogueState) -> Dict[str, Any]:
+    """
+    Generates a therapist turn and the patient's reply to it in a single call.
+    Falls back to the separate therapist and patient nodes if the combined
+    response cannot be parsed.
+    """
+    if "patient_memory" not in state:
+        state["patient_memory"] = PatientMemory()
+
+    history_text = state["history_text"]
+    display_history = history_text if history_text else "(no prior conversation – this is the first turn)"
+
+    session_prefix = state.get("session_prefix") or build_session_prefix(
+        state["session_number"], state["patient_profile_summary"], state["patient_memory"]
+    )
+
+    instructions = DUAL_ROLE_TEMPLATE.format(
+        session_prefix=session_prefix,
+        patient_profile=state["patient_profile"],
+        difficulty_description=state["difficulty_description"],
+        stressor_text=_format_stressor_text(state),
+        strategy_usage=state["strategy_usage_text"],
+        history_text=display_history,
+    )
+
+    response_str = await call_llm(
+        model=MODEL_THERAPIST,
+        instructions=instructions,
+        input_text="Write the next therapist turn and the patient's reply.",
+        max_output_tokens=640,  # Therapist turn (512) plus patient reply (128)
+        response_format=DUAL_ROLE_RESPONSE_FORMAT,
+        static_instructions=THERAPIST_STATIC_PROMPT,
+        prompt_cache_key=f"dialogue-pair-s{state['session_number']}",
+    )
+
+    try:
+        response_data = json.loads(response_str)
+        therapist_reply = response_data["therapist"].strip()
+        strategies_used = [s.strip() for s in response_data["strategies"] if s.strip()]
+        patient_reply = response_data["patient"].strip()
+        patient_resolution_status = bool(response_data["resolution"])
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        print(f"--- ERROR PARSING DUAL-ROLE JSON RESPONSE ---")
+        print(f"Failed to parse JSON: {e}")
+        print(f"Raw response: {response_str}")
+        # Fall back to one call per role for this turn pair
+        therapist_update = await therapist_node(state)
+        patient_update = await patient_node({**state, **therapist_update})
+        return {**therapist_update, **patient_update}
+
+    new_history = state["history"] + [
+        {"role": "therapist", "content": therapist_reply},
+        {"role": "patient", "content": patient_reply},
+    ]
+
+    new_history_text = append_history_text(state["history_text"], "therapist", therapist_reply)
+    new_history_text = append_history_text(new_history_text, "patient", patient_reply)
+
+    return {
+        "history": new_history,
+        "history_text": new_history_text,
+        "turn_index": state["turn_index"] + 2,
+        "strategy_history": state["strategy_history"] + strategies_used,
+        **update_strategy_usage(state, strategies_used),
+        "patient_resolution_status": patient_resolution_status,
     }
 
 
@@ -1075,7 +1729,7 @@ Key CBT signals to look for:
 """
 
 
-def run_rubric_scorer(dialogue: List[Dict[str, str]], patient_state: PatientMemory) -> Dict[str, Any]:
+async def run_rubric_scorer(dialogue: List[Dict[str, str]], patient_state: PatientMemory) -> Dict[str, Any]:
     """
     Evaluates the dialogue and returns motivation and confidence scores.
     """
@@ -1107,7 +1761,7 @@ OUTPUT FORMAT (STRICT):
 }}
 """
 
-    response_str = call_llm(
+    response_str = await call_llm(
         model=MODEL_THERAPIST,
         instructions=SCORER_SYSTEM_PROMPT,
         input_text=prompt,
@@ -1159,23 +1813,14 @@ def environment_agent_node(state: DialogueState) -> Dict[str, Any]:
     # --- Stressor Removal Logic ---
     updated_stressor_ledger = []
     for stressor in patient_memory.stressor_ledger:
-        duration = stressor.get("Likely Duration", "").lower()
+        if "stressor_index" in stressor:
+            lifetime = _STRESSOR_LIFETIMES[stressor["stressor_index"]]
+        else:
+            lifetime = _stressor_lifetime(stressor.get("Likely Duration", ""))
         session_added = stressor.get("session_added", session_number)
         sessions_active = session_number - session_added
 
-        remove = False
-        # Handle cases like "Days–Weeks" by checking for specific keywords.
-        if "minute" in duration or "hour" in duration or "day" in duration and "week" not in duration and "month" not in duration:
-            if sessions_active >= 1:
-                remove = True
-        elif "week" in duration and "month" not in duration:
-            if sessions_active >= 3:
-                remove = True
-        elif "month" in duration:
-            # Stressors with "Months" duration are not removed
-            pass
-
-        if not remove:
+        if lifetime is None or sessions_active < lifetime:
             updated_stressor_ledger.append(stressor)
     patient_memory.stressor_ledger = updated_stressor_ledger
     # --- End Stressor Removal ---
@@ -1183,7 +1828,8 @@ def environment_agent_node(state: DialogueState) -> Dict[str, Any]:
 
     # Randomly select 1 to 3 stressors to apply
     num_stressors = random.randint(1, 3)
-    selected_stressors = random.sample(ENVIRONMENT_STRESSORS, num_stressors)
+    selected_indices = random.sample(range(len(_STRESSOR_NAMES)), num_stressors)
+    selected_stressors = [_stressor_row(i) for i in selected_indices]
 
     patient_memory.apply_stressors(selected_stressors, session_number)
 
@@ -1245,6 +1891,34 @@ graph.add_conditional_edges(
 
 app = graph.compile()
 
+
+def route_after_pair(state: DialogueState) -> str:
+    """Determine next node after a combined therapist/patient exchange."""
+    if state["patient_resolution_status"]:
+        return END
+    if state["turn_index"] >= state["max_turns"]:
+        return END
+    return "dialogue_pair"
+
+
+# Build the single-node graph used for dual-role generation
+dual_role_graph = StateGraph(DialogueState)
+
+dual_role_graph.add_node("dialogue_pair", dialogue_pair_node)
+
+dual_role_graph.set_entry_point("dialogue_pair")
+
+dual_role_graph.add_conditional_edges(
+    "dialogue_pair",
+    route_after_pair,
+    {
+        "dialogue_pair": "dialogue_pair",
+        END: END,
+    },
+)
+
+dual_role_app = dual_role_graph.compile()
+
 # Execution and Output
 # Example Conversation Generation
 # replace 'example_patient_profile' with synthesized profiles
@@ -1287,84 +1961,174 @@ despite repeated negative experiences. There is also a past motivation to use al
 
 difficulty_setting = "hard"
 
-# Generate a concise summary of the patient profile to save tokens
-print("Summarizing patient profile...")
-patient_profile_summary = summarize_patient_profile(example_patient_profile.strip())
-print("Summary complete.")
+# Profiles to simulate; each gets its own six-session course and output file
+patient_profiles = [example_patient_profile.strip()]
+
+# Courses run concurrently on one event loop; the cap keeps in-flight requests
+# within the account's rate limits
+MAX_CONCURRENT_COURSES = 64
+
+
+def build_course_output(patient_profile: str, difficulty: str, sessions_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Builds the JSON output for a course from the sessions completed so far.
+    """
+    output_data = {
+        "patient_profile": patient_profile,
+        "difficulty": difficulty,
+        "sessions": sessions_data,
+    }
+
+    # Add the rubric scores from the final session to the top level of the output
+    if sessions_data:
+        final_scores = sessions_data[-1].get("rubric_scores", {})
+        if "motivation" in final_scores:
+            output_data["motivation"] = final_scores["motivation"]
+        if "confidence" in final_scores:
+            output_data["confidence"] = final_scores["confidence"]
+
+    return output_data
+
+
+def write_course_output(output_data: Dict[str, Any], path: str):
+    """Writes course output as indented JSON bytes via orjson."""
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
+
+
+async def run_course(
+    patient_profile: str,
+    difficulty: str,
+    output_path: str,
+    summary_task: Optional[asyncio.Task] = None,
+) -> Dict[str, Any]:
+    """
+    Runs the six-session course for one patient profile and returns the output data.
+    Sessions run in order because each one starts from the patient memory left by
+    the previous session's scorer and environment updates.
+    After every session the course so far is checkpointed to a ".partial_" file next
+    to output_path, which is renamed to output_path once all sessions are done.
+    `summary_task` is an already started summarize_patient_profile task for the
+    profile; without one, the summary is requested here.
+    """
+    partial_path = os.path.join(os.path.dirname(output_path), f".partial_{os.path.basename(output_path)}")
 
-# Store the data for all sessions
-sessions_data = []
+    # Generate a concise summary of the patient profile to save tokens
+    print("Summarizing patient profile...")
+    if summary_task is None:
+        summary_task = asyncio.create_task(summarize_patient_profile(patient_profile))
+    patient_profile_summary = await summary_task
+    print("Summary complete.")
 
-# Initialize Patient Memory
-patient_memory = PatientMemory()
+    # With DUAL_ROLE=1, easy/medium sessions generate both roles per call; hard sessions keep two calls
+    session_app = dual_role_app if USE_DUAL_ROLE and difficulty in DUAL_ROLE_DIFFICULTIES else app
 
-# Print initial memory state
-print("--- Initial Patient Memory State (Before Session 1) ---")
-print(patient_memory.get_summary())
+    # Store the data for all sessions
+    sessions_data = []
 
-# ✅ Apply environment stressors BETWEEN sessions
-for session_number in range(1, 7):
-    print(f"--- Running Session #{session_number} ---")
+    # Initialize Patient Memory
+    patient_memory = PatientMemory()
 
-    if session_number > 1:
-        state = {
+    # Print initial memory state
+    print("--- Initial Patient Memory State (Before Session 1) ---")
+    print(patient_memory.get_summary())
+
+    # ✅ Apply environment stressors BETWEEN sessions
+    for session_number in range(1, 7):
+        print(f"--- Running Session #{session_number} ---")
+
+        if session_number > 1:
+            state = {
+                "session_number": session_number,
+                "patient_memory": patient_memory,
+            }
+            state = environment_agent_node(state)
+            # Ensure we keep the mutated memory reference
+            patient_memory = state["patient_memory"]
+
+        initial_memory_summary = patient_memory.get_summary()
+
+        # Invoke the graph for the current session
+        result_state = await session_app.ainvoke({
+            "history": [],
+            "history_text": render_history_for_prompt([]),
+            "patient_profile": patient_profile,
+            "patient_profile_summary": patient_profile_summary,
+            "difficulty": difficulty,
+            "difficulty_description": DIFFICULTY_DESCRIPTIONS[difficulty],
+            "max_turns": 60,
+            "turn_index": 0,
+            "strategy_history": [],
+            "strategy_counts": Counter(),
+            "strategy_usage_text": format_strategy_usage(Counter()),
+            "patient_resolution_status": False,
             "session_number": session_number,
+            "session_prefix": build_session_prefix(session_number, patient_profile_summary, patient_memory),
             "patient_memory": patient_memory,
+        }, config={"recursion_limit": 200})
+
+        # Score the session and update patient memory
+        scores = await run_rubric_scorer(result_state["history"], patient_memory)
+        scorer_output = {
+            "delta_motivation": scores["motivation"]["score"] - patient_memory.motivation,
+            "delta_confidence": scores["confidence"]["score"] - patient_memory.confidence,
+            "raw_scores": scores
         }
-        state = environment_agent_node(state)
-        # Ensure we keep the mutated memory reference
-        patient_memory = state["patient_memory"]
-
-    initial_memory_summary = patient_memory.get_summary()
-
-    # Invoke the graph for the current session
-    result_state = app.invoke({
-        "history": [],
-        "patient_profile": example_patient_profile.strip(),
-        "patient_profile_summary": patient_profile_summary,
-        "difficulty": difficulty_setting,
-        "difficulty_description": DIFFICULTY_DESCRIPTIONS[difficulty_setting],
-        "max_turns": 60,
-        "turn_index": 0,
-        "strategy_history": [],
-        "patient_resolution_status": False,
-        "patient_state_summary": "",
-        "session_number": session_number,
-        "patient_memory": patient_memory,
-    }, config={"recursion_limit": 200})
-
-    # Score the session and update patient memory
-    scores = run_rubric_scorer(result_state["history"], patient_memory)
-    scorer_output = {
-        "delta_motivation": scores["motivation"]["score"] - patient_memory.motivation,
-        "delta_confidence": scores["confidence"]["score"] - patient_memory.confidence,
-        "raw_scores": scores
-    }
-    patient_memory = patient_state_update(patient_memory, scorer_output)
+        patient_memory = patient_state_update(patient_memory, scorer_output)
 
-    print(f"\nPatient memory state at the END of session {session_number}:")
-    print(patient_memory.get_summary())
+        print(f"\nPatient memory state at the END of session {session_number}:")
+        print(patient_memory.get_summary())
 
 
-    # Get the unique strategies used in this session
-    strategies_this_session = sorted(list(set(result_state.get("strategy_history", []))))
+        # Get the unique strategies used in this session
+        strategies_this_session = sorted(list(set(result_state.get("strategy_history", []))))
 
-    # Store the results for this session
-    session_data = {
-        "session_number": session_number,
-        "session_goals": SESSION_GOALS.get(session_number, {}),
-        "patient_memory_initial": initial_memory_summary,
-        "dialogue": result_state["history"],
-        "patient_memory_final": patient_memory.get_summary(),
-        "strategies_used": strategies_this_session,
-        "rubric_scores": scorer_output["raw_scores"],
-    }
-    sessions_data.append(session_data)
+        # Store the results for this session
+        session_data = {
+            "session_number": session_number,
+            "session_goals": SESSION_GOALS.get(session_number, {}),
+            "patient_memory_initial": initial_memory_summary,
+            "dialogue": result_state["history"],
+            "patient_memory_final": patient_memory.get_summary(),
+            "strategies_used": strategies_this_session,
+            "rubric_scores": scorer_output["raw_scores"],
+        }
+        sessions_data.append(session_data)
+        write_course_output(build_course_output(patient_profile, difficulty, sessions_data), partial_path)
 
-    if strategies_this_session:
-        print(f"**Strategies Used:** {', '.join(strategies_this_session)}")
+        if strategies_this_session:
+            print(f"**Strategies Used:** {', '.join(strategies_this_session)}")
+
+        print(f"\n--- Session {session_number} Complete ---\n")
+
+    # The last checkpoint already holds every session; promote it to the final file
+    os.replace(partial_path, output_path)
+    print(f"Saved dialogue to {output_path}")
+
+    return build_course_output(patient_profile, difficulty, sessions_data)
+
+
+async def run_courses(profiles: List[str], difficulty: str, paths: List[str]) -> List[Dict[str, Any]]:
+    """
+    Runs one course per profile concurrently, at most MAX_CONCURRENT_COURSES at a time.
+    A course's profile summary is requested while the course still waits for a
+    slot, so it is usually ready by the time the course starts. Summaries are
+    capped by their own semaphore of the same size.
+    """
+    course_semaphore = asyncio.Semaphore(MAX_CONCURRENT_COURSES)
+    summary_semaphore = asyncio.Semaphore(MAX_CONCURRENT_COURSES)
+
+    async def summarize_bounded(profile: str) -> str:
+        async with summary_semaphore:
+            return await summarize_patient_profile(profile)
+
+    async def run_bounded(profile: str, path: str) -> Dict[str, Any]:
+        summary_task = asyncio.create_task(summarize_bounded(profile))
+        async with course_semaphore:
+            return await run_course(profile, difficulty, path, summary_task)
+
+    return await asyncio.gather(*[run_bounded(profile, path) for profile, path in zip(profiles, paths)])
 
-    print(f"\n--- Session {session_number} Complete ---\n")
 
 # Set output directory
 output_dir = "."
@@ -1372,35 +2136,36 @@ os.makedirs(output_dir, exist_ok=True)
 
 # Create timestamped filename inside output directory
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-output_filename = f"simulated_dialogue_{timestamp}.json"
-output_path = os.path.join(output_dir, output_filename)
-
-# Prepare data for saving
-output_data = {
-    "patient_profile": example_patient_profile.strip(),
-    "difficulty": difficulty_setting,
-    "sessions": sessions_data,
-}
 
-# Add the rubric scores from the final session to the top level of the output
-if sessions_data:
-    final_scores = sessions_data[-1].get("rubric_scores", {})
-    if "motivation" in final_scores:
-        output_data["motivation"] = final_scores["motivation"]
-    if "confidence" in final_scores:
-        output_data["confidence"] = final_scores["confidence"]
-
-# Save JSON file
-with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(output_data, f, indent=2)
-
-print(f"Saved dialogue to {output_path}")
-
-# Print the rubric scores for all sessions
-print("\n--- Final Rubric Scores ---")
-for session_data in sessions_data:
-    session_number = session_data["session_number"]
-    rubric_scores = session_data["rubric_scores"]
-    print(f"\nSession {session_number}:")
-    print(f"  Motivation: {rubric_scores['motivation']['score']}")
-    print(f"  Confidence: {rubric_scores['confidence']['score']}")
+output_paths = []
+for course_index in range(len(patient_profiles)):
+    suffix = f"_{course_index + 1}" if len(patient_profiles) > 1 else ""
+    output_filename = f"simulated_dialogue_{timestamp}{suffix}.json"
+    output_paths.append(os.path.join(output_dir, output_filename))
+
+course_outputs = asyncio.run(run_courses(patient_profiles, difficulty_setting, output_paths))
+
+print(
+    f"Profile summaries from cache: {summary_cache.exact_hits} exact, "
+    f"{summary_cache.semantic_hits} reused from similar profiles"
+)
+if llm_cache is not None:
+    print(f"LLM responses replayed from cache: {llm_cache.hits}")
+print(
+    f"Prompt tokens: {prompt_token_usage['prompt_tokens']} "
+    f"(served from prompt cache: {prompt_token_usage['cached_tokens']})"
+)
+print(
+    f"Shared therapist prompt prefix: {THERAPIST_STATIC_PROMPT_TOKENS} static tokens "
+    f"+ {min(SESSION_PROMPT_BLOCK_TOKENS.values())}-{max(SESSION_PROMPT_BLOCK_TOKENS.values())} session tokens"
+)
+
+for output_data in course_outputs:
+    # Print the rubric scores for all sessions
+    print("\n--- Final Rubric Scores ---")
+    for session_data in output_data["sessions"]:
+        session_number = session_data["session_number"]
+        rubric_scores = session_data["rubric_scores"]
+        print(f"\nSession {session_number}:")
+        print(f"  Motivation: {rubric_scores['motivation']['score']}")
+        print(f"  Confidence: {rubric_scores['confidence']['score']}")
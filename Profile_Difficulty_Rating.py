@@ -1,36 +1,136 @@
 import os
-import csv
 import json
 import sys
+import asyncio
+import functools
+import hashlib
+import re
+import sqlite3
+import time
+import numpy as np
+import orjson
+from collections import defaultdict
 from dotenv import load_dotenv
-from openai import OpenAI, APIError
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIError, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+# pandas, tiktoken and faiss are imported where they are used, so a run that
+# fails validation (missing input file or API key) exits without loading them
 
 # ---------------------------------------------------------
 # ENV + CLIENT SETUP
 # ---------------------------------------------------------
-load_dotenv()
+# Created by create_client() when processing starts, so importing this module
+# neither requires an API key nor builds a network client
+client = None
+
+def create_http_client():
+    """
+    Pooled HTTP client for the OpenAI API. With HTTP/2 (needs the optional `h2`
+    package, `pip install httpx[http2]`) concurrent requests are multiplexed over
+    a few connections instead of a TLS handshake per connection.
+    """
+    options = {
+        "limits": httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        "timeout": httpx.Timeout(60.0, connect=10.0),
+    }
+    try:
+        return DefaultAsyncHttpxClient(http2=True, **options)
+    except ImportError:
+        return DefaultAsyncHttpxClient(**options)  # HTTP/1.1 keep-alive pool
+
+def create_client():
+    """
+    Loads OPENAI_API_KEY from the environment / .env file and returns an AsyncOpenAI client.
+    Exits with an error message if the key is missing or the client cannot be built.
+    """
+    load_dotenv()
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        print("ERROR: The OPENAI_API_KEY environment variable is not set.")
+        print("Please create a .env file in the script's directory and add the following line:")
+        print("OPENAI_API_KEY='your_api_key_here'")
+        sys.exit(1)
+
+    try:
+        return AsyncOpenAI(api_key=api_key, http_client=create_http_client())
+    except Exception as e:
+        print(f"ERROR: Failed to initialize OpenAI client: {e}")
+        sys.exit(1)
+
+# Model cascade: every profile goes to the fast model first and is escalated
+# to the strong model only when the fast model is unsure or off-schema
+MODEL_FAST = "gpt-4o-mini"
+MODEL_STRONG = "gpt-4o"
+CASCADE_CONFIDENCE_THRESHOLD = 0.75
+
+# Errors worth retrying with backoff: rate limits, timeouts, dropped connections
+# and 5xx responses. Anything else (e.g. a 400) fails the request immediately.
+TRANSIENT_API_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
 
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    print("ERROR: The OPENAI_API_KEY environment variable is not set.")
-    print("Please create a .env file in the script's directory and add the following line:")
-    print("OPENAI_API_KEY='your_api_key_here'")
-    sys.exit(1)
+# Maximum number of classification requests in flight at once
+MAX_CONCURRENT_REQUESTS = 20
 
-try:
-    client = OpenAI(api_key=api_key)
-except Exception as e:
-    print(f"ERROR: Failed to initialize OpenAI client: {e}")
-    sys.exit(1)
+# Per-model (requests per minute, tokens per minute) limits for live requests.
+# Defaults are OpenAI's tier-1 limits; raise them to match the account's tier.
+RATE_LIMITS = {
+    "gpt-4o-mini": (500, 200_000),
+    "gpt-4o": (500, 30_000),
+}
 
-MODEL_PATIENT = "gpt-4o"
+# Batch prompting: up to this many profiles are classified in one request so
+# the rubric in the system prompt is paid for once per group instead of once
+# per profile. Groups are closed early once their combined profile text would
+# exceed the character budget (~4 characters per token, ~6000 input tokens).
+PROFILES_PER_REQUEST = 6
+GROUP_PROMPT_MAX_CHARS = 24000
+
+# Submit cache misses through the OpenAI Batch API (~50% cheaper, separate and
+# higher rate limits, up to 24h turnaround). Set to False for live requests,
+# which are grouped several profiles per call and use the model cascade.
+USE_BATCH_API = True
+BATCH_POLL_SECONDS = 60
+# Profiles are split by token length into this many batches, so long profiles
+# don't hold up batches of short ones
+BATCH_LENGTH_BINS = 3
+TOKENIZER_ENCODING = "o200k_base"  # gpt-4o / gpt-4o-mini tokenizer
+MAX_PROFILE_TOKENS = 6000  # Longer profiles are truncated before they are sent
+
+# 1 MiB read buffer for the input CSV and the JSONL results log (default is 8 KiB)
+READ_BUFFER_SIZE = 1 << 20
 
 INPUT_FILE = r"C:\Users\vikto\RecoveryBot Project\Patient_Profiles_Nov9.csv"
-OUTPUT_FILE = r"C:\Users\vikto\RecoveryBot Project\Patient_Profiles_Rated.json"
+# Results are appended to OUTPUT_FILE (one JSON object per line) as they complete,
+# so an interrupted run can be resumed; EXPORT_JSON_FILE is the final JSON array
+OUTPUT_FILE = r"C:\Users\vikto\RecoveryBot Project\Patient_Profiles_Rated.jsonl"
+EXPORT_JSON_FILE = r"C:\Users\vikto\RecoveryBot Project\Patient_Profiles_Rated.json"
+BATCH_REQUESTS_FILE = r"C:\Users\vikto\RecoveryBot Project\Patient_Profiles_Batch_Requests.jsonl"
+
+# Classification cache: a profile whose exact text was classified before reuses
+# that classification. With PROFILE_SEMANTIC_CACHE=1 a profile whose embedding is
+# near-identical (cosine similarity above the threshold) to one already classified
+# reuses it as well. The semantic path is opt-in: a distinct profile would inherit
+# another profile's barriers and difficulty label, and the similarity is computed
+# on int8-quantized vectors. Output rows record which cached profile they came from.
+USE_SEMANTIC_CACHE = os.getenv("PROFILE_SEMANTIC_CACHE", "0") == "1"
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.93
+EMBEDDING_BATCH_SIZE = 512  # Profiles per embeddings request (the API accepts up to 2048)
+CACHE_VECTORS_FILE = r"C:\Users\vikto\RecoveryBot Project\Profile_Classification_Cache.npy"
+CACHE_ENTRIES_FILE = r"C:\Users\vikto\RecoveryBot Project\Profile_Classification_Cache.json"
+
+# Response cache: raw model responses persisted in SQLite, keyed on the model,
+# the system prompt and the user prompt, so reruns skip requests already answered
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_FILE = r"C:\Users\vikto\RecoveryBot Project\Profile_Classification_Responses.sqlite"
 
 # ---------------------------------------------------------
 # SYSTEM PROMPT (STRICT CLASSIFICATION LOGIC)
 # ---------------------------------------------------------
+# The full rubric is part of the system prompt so every request shares the
+# same byte-identical prefix, which OpenAI's automatic prompt caching reuses.
 SYSTEM_PROMPT = """
 You are a clinical classification assistant.
 
@@ -41,59 +141,7 @@ Your task:
 4. Do NOT invent information.
 5. If evidence is unclear, do NOT assign that barrier.
 
-Use the barrier names as provided.
-"""
-
-# ---------------------------------------------------------
-# PARSE LLM OUTPUT
-# ---------------------------------------------------------
-def parse_llm_output(text):
-    """
-    Parses the raw text output from the language model to extract
-    the barrier list and difficulty rating.
-    """
-    barrier_list = []
-    difficulty_rating = ""
-    lines = text.strip().split('\n')
-
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-
-        if line.startswith("Barrier List:"):
-            i += 1
-            while i < len(lines) and lines[i].strip().startswith("-"):
-                barrier_list.append(lines[i].strip()[1:].strip())
-                i += 1
-            continue # Continue to the next part of the main loop
-
-        if line.startswith("Difficulty Level:"):
-            # The rating might be on the same line or the next one
-            rating = line.replace("Difficulty Level:", "").strip()
-            if rating:
-                difficulty_rating = rating
-            elif i + 1 < len(lines) and lines[i+1].strip():
-                difficulty_rating = lines[i+1].strip()
-                i += 1 # Move past the rating value line
-            i += 1
-            continue
-
-        i += 1
-
-    return barrier_list, difficulty_rating or "Unknown"
-
-# ---------------------------------------------------------
-# PROCESS FILES
-# ---------------------------------------------------------
-def get_patient_classification(profile_text):
-    """
-    Calls the OpenAI API to get the classification for a single patient profile.
-    """
-    # The classification prompt is now constructed directly within this function
-    # to avoid the NameError from the missing build_prompt function.
-    user_prompt = f"""
-PATIENT PROFILE:
-{profile_text}
+Use the barrier codes as provided (A1-C2).
 
 -----------------------------------
 BARRIER CLASSIFICATION RULES
@@ -166,7 +214,7 @@ Assign if ANY:
 DIFFICULTY RATING RULES
 -----------------------------------
 
-🔴 HARD
+HARD
 Assign hard rating if ANY of the following are present:
 -  High-resistance indicators (i.e. Long-term heavy use (multi-year pattern), Repeated relapse despite treatment, Strong distrust of providers, Severe emotional dysregulation (hopelessness, self-destructive coping), Alcohol used as primary coping mechanism),
 OR
@@ -174,9 +222,9 @@ Barriers in 3 domains,
 OR
 Severe emotional reliance + social or systemic barrier
 Typical profile:
-“Alcohol is the only thing that helps and I don’t trust treatment.”
+"Alcohol is the only thing that helps and I don't trust treatment."
 
-🟢 EASY
+EASY
 ALL must be true:
 Barriers present in 1 domain only
 AND
@@ -184,38 +232,541 @@ NO high-resistance indicators
 AND
 Clear motivation and willingness to cooperate
 Typical profile:
-“I want to stop, I know alcohol is a problem, I just need structure.”
+"I want to stop, I know alcohol is a problem, I just need structure."
 
-🟡 MEDIUM
+MEDIUM
 Barriers in 2 domains,
 OR
 Psychological ambivalence present,
 OR
 Habitual/emotional reliance without severe dysregulation
 Typical profile:
-“I know it’s a problem, but I keep slipping when stressed.”
+"I know it's a problem, but I keep slipping when stressed."
 
 -----------------------------------
 OUTPUT FORMAT (STRICT)
 -----------------------------------
 
-Barrier List:
-- [Barrier Name]
-- [Barrier Name]
-
-Difficulty Level:
-Easy / Medium / Hard
+Return a JSON object with:
+- "barriers": the codes of the assigned barriers (e.g. "A2")
+- "difficulty": "Easy", "Medium" or "Hard"
+- "confidence": how confident you are in this classification, from 0.0 to 1.0
 """
+
+BARRIER_NAMES = [
+    "A1. Psychological Resistance (Denial / Ambivalence)",
+    "A2. Emotional Reliance on Alcohol",
+    "A3. Fear of Withdrawal / Fear of Sobriety",
+    "A4. Compulsive or Habitual Use",
+    "B1. Disrupted Social Support",
+    "B2. Fear of Judgment / Stigma",
+    "B3. Social Exposure to Drinking",
+    "C1. Distrust in Healthcare or Treatment",
+    "C2. Access Barriers",
+]
+
+# The model answers with the short codes (fewer output tokens); responses are
+# mapped back to the full names before they are written
+BARRIER_NAMES_BY_CODE = {name.split(".", 1)[0]: name for name in BARRIER_NAMES}
+
+# Structured output: the model must return JSON matching this schema, which
+# removes parsing ambiguity and keeps the response short enough for a tight cap
+CLASSIFICATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "classification",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "barriers": {"type": "array", "items": {"type": "string", "enum": list(BARRIER_NAMES_BY_CODE)}},
+                "difficulty": {"type": "string", "enum": ["Easy", "Medium", "Hard"]},
+                "confidence": {"type": "number"},
+            },
+            "required": ["barriers", "difficulty", "confidence"],
+            "additionalProperties": False,
+        },
+    },
+}
+CLASSIFICATION_MAX_TOKENS = 80
+
+# Every classification request shares SYSTEM_PROMPT as its prefix; a common
+# cache key routes them to the same prompt-cache shards, raising the hit rate
+PROMPT_CACHE_KEY = "profile-difficulty-classification"
+
+# Grouped variant: one classification per profile, each tagged with the number
+# of the profile it belongs to so answers can't silently shift between patients.
+# Strict structured output needs an object at the root, so the list is wrapped.
+_CLASSIFICATION_SCHEMA = CLASSIFICATION_RESPONSE_FORMAT["json_schema"]["schema"]
+GROUP_CLASSIFICATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "classifications",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        **_CLASSIFICATION_SCHEMA,
+                        "properties": {"profile_number": {"type": "integer"}, **_CLASSIFICATION_SCHEMA["properties"]},
+                        "required": ["profile_number", *_CLASSIFICATION_SCHEMA["required"]],
+                    },
+                },
+            },
+            "required": ["results"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# ---------------------------------------------------------
+# PARSE LLM OUTPUT
+# ---------------------------------------------------------
+def parse_llm_output(text):
+    """
+    Extracts the barrier list and difficulty rating from a model response.
+    Responses are JSON (structured output) with barrier codes, which are mapped
+    to the full barrier names; classifications cached before the switch to
+    structured output are still in the legacy text format.
+    """
     try:
-        response = client.chat.completions.create(
-            model=MODEL_PATIENT,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0
+        classification = json.loads(text)
+        barrier_list = [BARRIER_NAMES_BY_CODE.get(barrier, barrier) for barrier in classification["barriers"]]
+        return barrier_list, classification["difficulty"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return parse_legacy_output(text)
+
+# Legacy text format: a "Barrier List:" line followed by its "- item" lines, and
+# a "Difficulty Level:" line (anywhere in the text) with the rating on the same
+# line or the next, possibly in **bold**. The two are matched independently.
+_BARRIER_RE = re.compile(r"Barrier List:[^\n]*\n((?:[ \t]*-.*(?:\n|$))*)", re.IGNORECASE)
+_DIFFICULTY_RE = re.compile(r"Difficulty Level:[ \t*]*(?:\n[ \t*]*)?([^\n*]*[^\s*])", re.IGNORECASE)
+_DIFFICULTY_LEVELS = {"easy", "medium", "hard", "unknown"}
+
+def parse_legacy_output(text):
+    """
+    Parses the legacy "Barrier List: / Difficulty Level:" text format to extract
+    the barrier list and difficulty rating with compiled-regex scans.
+    The last "Difficulty Level:" wins; known ratings are normalised to
+    Easy/Medium/Hard/Unknown and anything else is returned as written.
+    """
+    match = _BARRIER_RE.search(text)
+    barrier_list = [line.strip()[1:].strip() for line in match.group(1).splitlines() if line.strip()] if match else []
+    ratings = _DIFFICULTY_RE.findall(text)
+    if not ratings:
+        return barrier_list, "Unknown"
+    difficulty_rating = ratings[-1].strip()
+    if difficulty_rating.lower() in _DIFFICULTY_LEVELS:
+        difficulty_rating = difficulty_rating.capitalize()
+    return barrier_list, difficulty_rating
+
+# Running token totals, used to confirm that prompt caching is being hit
+token_usage = {"prompt_tokens": 0, "cached_tokens": 0}
+
+# How many classifications the fast model settled vs. escalated
+cascade_stats = {"fast": 0, "escalated": 0}
+
+# Opened in process_profiles() when USE_RESPONSE_CACHE is set
+response_cache = None
+
+# ---------------------------------------------------------
+# CLASSIFICATION CACHE
+# ---------------------------------------------------------
+class ClassificationCache:
+    """
+    Exact + semantic cache of raw classification texts.
+    Exact hits are keyed on SHA1(profile_text); semantic hits use inner product
+    over L2-normalized embeddings (i.e. cosine similarity). Entries added without
+    an embedding only serve exact hits.
+    Lookups return the matching entry, which names the profile it was made for.
+    Embeddings are kept int8-quantized (4x smaller than float32): unit vectors
+    have every component in [-1, 1], so a fixed scale of 127 needs no training.
+    Persisted as a .npy matrix of int8 vectors plus a JSON list of entries; the
+    vectors are parallel to the entries that have one.
+    """
+    INT8_SCALE = 127.0
+
+    def __init__(self, vectors_file, entries_file, threshold):
+        self.vectors_file = vectors_file
+        self.entries_file = entries_file
+        self.threshold = threshold
+        self.vectors = None
+        self.entries = []  # [{"sha1": ..., "patient_id": ..., "classification": ..., "embedded": ...}]
+        self.embedded_entries = []  # Indices into entries, parallel to vectors
+        self.exact = {}
+        self.index = None
+        try:
+            import faiss
+        except ImportError:
+            faiss = None  # Fall back to a NumPy dot-product search
+        self.faiss = faiss
+
+        if os.path.exists(vectors_file) and os.path.exists(entries_file):
+            self.vectors = np.load(vectors_file)
+            if not len(self.vectors):
+                self.vectors = None  # Only exact-only entries so far
+            elif self.vectors.dtype != np.int8:
+                # Cache files written before quantization hold float32 vectors
+                self.vectors = self.quantize(self.vectors)
+            with open(entries_file, 'rb') as f:
+                self.entries = orjson.loads(f.read())
+            self.exact = {entry["sha1"]: entry for entry in self.entries}
+            # Entries written before exact-only entries existed all have a vector
+            self.embedded_entries = [
+                position for position, entry in enumerate(self.entries) if entry.get("embedded", True)
+            ]
+            if self.faiss is not None and len(self.embedded_entries):
+                self.index = self.new_index(self.vectors.shape[1])
+                self.index.add(self.dequantize(self.vectors))
+
+    @staticmethod
+    def profile_key(profile_text):
+        return hashlib.sha1(profile_text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def quantize(cls, vectors):
+        return np.clip(np.rint(vectors * cls.INT8_SCALE), -127, 127).astype(np.int8)
+
+    @classmethod
+    def dequantize(cls, vectors):
+        return vectors.astype(np.float32) / cls.INT8_SCALE
+
+    def new_index(self, dim):
+        """
+        FAISS 8-bit scalar-quantizer index over the fixed [-1, 1] range.
+        """
+        faiss = self.faiss
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit_uniform, faiss.METRIC_INNER_PRODUCT)
+        index.train(np.array([[-1.0] * dim, [1.0] * dim], dtype=np.float32))
+        return index
+
+    def lookup_exact(self, profile_text):
+        """Returns the entry for this exact profile text, or None."""
+        return self.exact.get(self.profile_key(profile_text))
+
+    def lookup_similar(self, embedding):
+        """Returns the nearest entry and its similarity if it is above the threshold, else None."""
+        if not self.embedded_entries:
+            return None
+        if self.index is not None:
+            scores, ids = self.index.search(embedding.reshape(1, -1), 1)
+            best_score, best_id = scores[0, 0], ids[0, 0]
+        else:
+            similarities = (self.vectors @ embedding) / self.INT8_SCALE
+            best_id = int(np.argmax(similarities))
+            best_score = similarities[best_id]
+        if best_score > self.threshold:
+            return self.entries[self.embedded_entries[best_id]], float(best_score)
+        return None
+
+    def add(self, profile_text, patient_id, embedding, classification):
+        entry = {
+            "sha1": self.profile_key(profile_text),
+            "patient_id": patient_id,
+            "classification": classification,
+            "embedded": embedding is not None,
+        }
+        self.entries.append(entry)
+        self.exact[entry["sha1"]] = entry
+        if embedding is None:
+            return
+        self.embedded_entries.append(len(self.entries) - 1)
+        row = self.quantize(embedding.reshape(1, -1))
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        if self.faiss is not None:
+            if self.index is None:
+                self.index = self.new_index(row.shape[1])
+            self.index.add(self.dequantize(row))
+
+    def save(self):
+        if not self.entries:
+            return
+        dim = self.vectors.shape[1] if self.vectors is not None else 0
+        np.save(self.vectors_file, self.vectors if self.vectors is not None else np.zeros((0, dim), dtype=np.int8))
+        with open(self.entries_file, 'wb') as f:
+            f.write(orjson.dumps(self.entries))
+
+class ResponseCache:
+    """
+    Persistent cache of raw classification responses.
+    Keys are BLAKE2b digests of (model, system prompt hash, user prompt), so a
+    rubric or model change never serves a stale response.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
         )
-        return response.choices[0].message.content.strip()
+        self.connection.commit()
+        self.system_prompt_hash = hashlib.blake2b(SYSTEM_PROMPT.encode('utf-8'), digest_size=16).hexdigest()
+        self.hits = 0
+
+    def key(self, model, user_prompt):
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (model, self.system_prompt_hash, user_prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, response):
+        self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, response))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_API_ERRORS),
+    wait=wait_random_exponential(1, 60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _request_embeddings(texts):
+    return await client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+
+async def embed_profiles(profile_texts):
+    """
+    Returns the L2-normalized embeddings of the profiles as an (N, dim) float32
+    matrix, requesting EMBEDDING_BATCH_SIZE profiles per embeddings call.
+    The calls for the different chunks are issued concurrently.
+    """
+    responses = await asyncio.gather(*[
+        _request_embeddings(profile_texts[start:start + EMBEDDING_BATCH_SIZE])
+        for start in range(0, len(profile_texts), EMBEDDING_BATCH_SIZE)
+    ])
+    embeddings = []
+    for response in responses:
+        # Sort by index so rows line up with the inputs whatever order they come back in
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+# ---------------------------------------------------------
+# TOKEN COUNTING + RATE LIMITING
+# ---------------------------------------------------------
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    """
+    Returns the TOKENIZER_ENCODING tiktoken encoding, or None if it cannot be loaded.
+    """
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # The encoding is downloaded on first use; estimate ~4 characters per token without it
+        print(f"WARNING: Could not load the {TOKENIZER_ENCODING} tokenizer, estimating token counts: {e}")
+        return None
+
+def count_tokens(texts):
+    """
+    Returns the token count of each text.
+    """
+    encoding = get_tokenizer()
+    if encoding is None:
+        return [len(text) // 4 for text in texts]
+    return [len(tokens) for tokens in encoding.encode_batch(texts)]
+
+def truncate_profile(profile_text):
+    """
+    Truncates a profile to MAX_PROFILE_TOKENS so one oversized row cannot blow
+    the context window or the TPM budget.
+    """
+    encoding = get_tokenizer()
+    if encoding is None:
+        return profile_text[:MAX_PROFILE_TOKENS * 4]
+    tokens = encoding.encode(profile_text)
+    if len(tokens) <= MAX_PROFILE_TOKENS:
+        return profile_text
+    return encoding.decode(tokens[:MAX_PROFILE_TOKENS])
+
+class RateLimiter:
+    """
+    Token-bucket limiter for one model's requests-per-minute and tokens-per-minute
+    limits. Both buckets refill continuously; acquire() waits until both can
+    cover a request, so bursts from gather() are smoothed out instead of
+    turning into 429 responses and backoff.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.requests_per_minute,
+                                      self.available_requests + elapsed * self.requests_per_minute / 60)
+        self.available_tokens = min(self.tokens_per_minute,
+                                    self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tokens_per_minute)  # A request larger than the bucket would wait forever
+        # Holding the lock while waiting serves callers in arrival order
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait_seconds = max(
+                    (1 - self.available_requests) * 60 / self.requests_per_minute,
+                    (tokens - self.available_tokens) * 60 / self.tokens_per_minute,
+                )
+                await asyncio.sleep(max(wait_seconds, 0.01))
+
+rate_limiters = {}
+
+def get_rate_limiter(model):
+    """
+    Returns the shared RateLimiter for a model, or None if it has no configured limits.
+    """
+    if model not in RATE_LIMITS:
+        return None
+    if model not in rate_limiters:
+        rate_limiters[model] = RateLimiter(*RATE_LIMITS[model])
+    return rate_limiters[model]
+
+# ---------------------------------------------------------
+# PROCESS FILES
+# ---------------------------------------------------------
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_API_ERRORS),
+    wait=wait_random_exponential(1, 60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _request_classification(user_prompt, model,
+                                  response_format=CLASSIFICATION_RESPONSE_FORMAT,
+                                  max_tokens=CLASSIFICATION_MAX_TOKENS):
+    """
+    Sends one classification request, backing off exponentially on rate limits
+    and other transient errors.
+    The request first waits for the model's RPM/TPM budget, charged with the
+    estimated prompt tokens plus the output cap.
+    Responses already in the response cache are returned without a request.
+    """
+    if response_cache is not None:
+        cache_key = response_cache.key(model, user_prompt)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    rate_limiter = get_rate_limiter(model)
+    if rate_limiter is not None:
+        await rate_limiter.acquire(sum(count_tokens([SYSTEM_PROMPT, user_prompt])) + max_tokens)
+
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.0,
+        max_tokens=max_tokens,
+        response_format=response_format,
+        prompt_cache_key=PROMPT_CACHE_KEY
+    )
+    if response.usage is not None:
+        token_usage["prompt_tokens"] += response.usage.prompt_tokens
+        details = response.usage.prompt_tokens_details
+        if details is not None and details.cached_tokens:
+            token_usage["cached_tokens"] += details.cached_tokens
+    content = response.choices[0].message.content.strip()
+    if response_cache is not None and content:
+        response_cache.put(cache_key, content)
+    return content
+
+# Static tail of every single-profile user message; the classification rules
+# live in SYSTEM_PROMPT, so only the profile is formatted per request
+USER_PROMPT_SUFFIX = "\n\nReturn output in the specified format."
+
+def build_prompt(profile_text):
+    """
+    Builds the user message for one patient profile.
+    """
+    return f"PATIENT PROFILE:\n{truncate_profile(profile_text)}{USER_PROMPT_SUFFIX}"
+
+def build_group_prompt(profile_texts):
+    """
+    Builds the user message for a group of profiles, numbered 1..K.
+    """
+    numbered_profiles = "\n".join(
+        f"PATIENT PROFILE {number}:\n{truncate_profile(profile_text)}" for number, profile_text in enumerate(profile_texts, 1)
+    )
+    return (
+        f"Classify each of the {len(profile_texts)} patient profiles below independently.\n\n"
+        f"{numbered_profiles}\n"
+        f"Return a JSON object whose \"results\" array holds exactly {len(profile_texts)} "
+        f"classifications in the specified format, one per profile, in the same order, "
+        f"each with \"profile_number\" set to the number of the profile it classifies."
+    )
+
+def group_profiles(profile_texts):
+    """
+    Splits profile indices into groups of at most PROFILES_PER_REQUEST whose
+    combined text stays within GROUP_PROMPT_MAX_CHARS.
+    """
+    groups = []
+    current_group = []
+    current_chars = 0
+    for index, profile_text in enumerate(profile_texts):
+        if current_group and (len(current_group) == PROFILES_PER_REQUEST
+                              or current_chars + len(profile_text) > GROUP_PROMPT_MAX_CHARS):
+            groups.append(current_group)
+            current_group = []
+            current_chars = 0
+        current_group.append(index)
+        current_chars += len(profile_text)
+    if current_group:
+        groups.append(current_group)
+    return groups
+
+def _is_confident(classification_text):
+    """
+    True if a structured classification is valid and confident enough to keep.
+    """
+    try:
+        classification = json.loads(classification_text)
+        confidence = float(classification["confidence"])
+        difficulty = classification["difficulty"]
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return False
+    return confidence >= CASCADE_CONFIDENCE_THRESHOLD and difficulty in {"Easy", "Medium", "Hard"}
+
+async def get_patient_classification(profile_text, fast_text=None):
+    """
+    Calls the OpenAI API to get the classification for a single patient profile.
+    The fast model answers first (or `fast_text`, if a grouped request already
+    produced its answer); the strong model is used only if the fast model's
+    confidence is below CASCADE_CONFIDENCE_THRESHOLD or its output does not validate.
+    """
+    user_prompt = build_prompt(profile_text)
+    try:
+        if fast_text is None:
+            fast_text = await _request_classification(user_prompt, MODEL_FAST)
+        if _is_confident(fast_text):
+            cascade_stats["fast"] += 1
+            return fast_text
+
+        cascade_stats["escalated"] += 1
+        return await _request_classification(user_prompt, MODEL_STRONG)
     except APIError as e:
         print(f"  !! API Error during classification: {e}")
         return None
@@ -223,86 +774,429 @@ Easy / Medium / Hard
         print(f"  !! An unexpected error occurred during API call: {e}")
         return None
 
-def process_profiles():
+async def get_group_classification(profile_texts):
     """
-    Reads profiles from a CSV, gets ratings, and saves them to a single JSON file.
-    This function is designed to handle CSVs where each patient's data spans multiple rows.
+    Classifies a group of profiles with a single fast-model request and returns
+    one classification text per profile, in order. Each answer then goes
+    through the usual cascade; if the grouped response is unusable, every
+    profile in the group is classified on its own.
+    """
+    if len(profile_texts) == 1:
+        return [await get_patient_classification(profile_texts[0])]
+
+    results = []
+    try:
+        response_text = await _request_classification(
+            build_group_prompt(profile_texts), MODEL_FAST,
+            response_format=GROUP_CLASSIFICATION_RESPONSE_FORMAT,
+            max_tokens=CLASSIFICATION_MAX_TOKENS * len(profile_texts)
+        )
+        results = sorted(json.loads(response_text)["results"], key=lambda result: result["profile_number"])
+    except Exception as e:
+        print(f"  !! Grouped classification failed, classifying profiles one at a time: {e}")
+
+    if [result["profile_number"] for result in results] != list(range(1, len(profile_texts) + 1)):
+        if results:
+            print(f"  !! Expected classifications for profiles 1-{len(profile_texts)}, got "
+                  f"{[result['profile_number'] for result in results]}. Classifying profiles one at a time.")
+        return await asyncio.gather(*[get_patient_classification(text) for text in profile_texts])
+
+    # Drop the group-only profile_number so the text matches the single-profile format
+    return await asyncio.gather(*[
+        get_patient_classification(text, fast_text=json.dumps(
+            {key: value for key, value in result.items() if key != "profile_number"}))
+        for text, result in zip(profile_texts, results)
+    ])
+
+def read_patient_profiles(input_file):
+    """
+    Yields (patient_id, profile_text) for each patient record in the CSV.
+    Each patient's data spans multiple rows: a "User ID" row starts a record,
+    a "---" row ends it, and the rows in between are "field: value" lines.
     """
-    all_results = []
     current_patient_id = None
-    current_profile_text = ""
+    # Lines are collected in a list and joined once per patient, rather than
+    # re-building the profile string on every row
+    current_profile_lines = []
 
-    def process_single_patient(patient_id, profile_text):
-        """Helper function to process one patient's complete profile."""
-        if not patient_id or not profile_text.strip():
-            print(f"WARNING: Skipping patient record with incomplete data. ID: {patient_id}")
-            return
+    import pandas as pd
 
-        print(f"Processing patient: {patient_id}...")
-        classification_text = get_patient_classification(profile_text)
-
-        if classification_text:
-            barrier_list, difficulty_rating = parse_llm_output(classification_text)
-            all_results.append({
-                "Patient ID": patient_id,
-                "Patient Profile Summary": profile_text.strip(),
-                "Barrier list": barrier_list,
-                "Difficulty Level": difficulty_rating
-            })
-        else:
-            print(f"WARNING: Failed to classify patient {patient_id}. Skipping.")
+    # pandas' C parser reads the two-column file much faster than csv.reader;
+    # keep_default_na=False keeps empty cells as "" rather than NaN
+    with open(input_file, mode='r', encoding='latin-1', newline='', buffering=READ_BUFFER_SIZE) as infile:
+        rows = pd.read_csv(
+            infile, header=None, usecols=[0, 1], names=["field", "value"],
+            dtype=str, keep_default_na=False
+        )
 
-    try:
-        print(f"INFO: Reading input file: {INPUT_FILE}")
-        with open(INPUT_FILE, mode='r', encoding='latin-1') as infile:
-            reader = csv.reader(infile)
-
-            for row in reader:
-                if not row or not any(field.strip() for field in row):
-                    continue  # Skip empty rows
-
-                col1 = row[0].strip()
-                col2 = row[1].strip() if len(row) > 1 else ""
-
-                # A row with "User ID" and a UUID in the next column marks a new patient
-                if "User ID" in col1 and len(col2) > 20:
-                    # If we were already building a patient, process them first
-                    if current_patient_id:
-                        process_single_patient(current_patient_id, current_profile_text)
-
-                    # Start the new patient record
-                    current_patient_id = col2
-                    current_profile_text = ""
-                # A separator line marks the end of a patient record
-                elif "---" in col1:
-                    if current_patient_id:
-                        process_single_patient(current_patient_id, current_profile_text)
-                    # Reset for the next block
-                    current_patient_id = None
-                    current_profile_text = ""
-                # Otherwise, it's content for the current patient
-                elif current_patient_id:
-                    current_profile_text += f"{col1}: {col2}\n"
-
-            # After the loop, process the last patient in the file if they exist
+    for col1, col2 in rows.itertuples(index=False, name=None):
+        col1 = col1.strip()
+        col2 = col2.strip()
+        if not col1 and not col2:
+            continue  # Skip empty rows
+
+        # A row with "User ID" and a UUID in the next column marks a new patient
+        if "User ID" in col1 and len(col2) > 20:
+            # If we were already building a patient, emit them first
             if current_patient_id:
-                process_single_patient(current_patient_id, current_profile_text)
+                yield current_patient_id, "".join(current_profile_lines)
+
+            # Start the new patient record
+            current_patient_id = col2
+            current_profile_lines = []
+        # A separator line marks the end of a patient record
+        elif "---" in col1:
+            if current_patient_id:
+                yield current_patient_id, "".join(current_profile_lines)
+            # Reset for the next block
+            current_patient_id = None
+            current_profile_lines = []
+        # Otherwise, it's content for the current patient
+        elif current_patient_id:
+            current_profile_lines.append(f"{col1}: {col2}\n")
+
+    # After the loop, emit the last patient in the file if they exist
+    if current_patient_id:
+        yield current_patient_id, "".join(current_profile_lines)
+
+def read_jsonl(jsonl_file):
+    """
+    Yields the records of a JSONL file. A truncated last line (left behind by
+    an interrupted run) is skipped.
+    """
+    with open(jsonl_file, 'rb', buffering=READ_BUFFER_SIZE) as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                print(f"WARNING: Skipping malformed line in {jsonl_file}")
 
-        # Write the final results to the JSON file
+def load_completed_ids(jsonl_file):
+    """
+    Returns the IDs of patients already written to the JSONL output.
+    """
+    if not os.path.exists(jsonl_file):
+        return set()
+    return {record["Patient ID"] for record in read_jsonl(jsonl_file)}
+
+def output_ends_with_newline(jsonl_file):
+    """
+    True if the file is empty or its last byte is a newline.
+    """
+    with open(jsonl_file, 'rb') as infile:
+        infile.seek(0, os.SEEK_END)
+        if infile.tell() == 0:
+            return True
+        infile.seek(-1, os.SEEK_END)
+        return infile.read(1) == b"\n"
+
+def jsonl_to_json(jsonl_file, json_file):
+    """
+    Converts the JSONL results log into a single JSON array file.
+    """
+    # Records are streamed one at a time, so the export never holds the whole
+    # result set in memory; each is written compactly on its own line
+    with open(json_file, 'wb') as outfile:
+        record_count = 0
+        for record in read_jsonl(jsonl_file):
+            outfile.write(b",\n" if record_count else b"[\n")
+            outfile.write(orjson.dumps(record))
+            record_count += 1
+        outfile.write(b"\n]\n" if record_count else b"[]\n")
+
+def split_into_length_bins(profile_texts, num_bins):
+    """
+    Splits profile indices into `num_bins` bins of similar token length (by
+    quantile), so no batch mixes very short and very long profiles.
+    """
+    token_counts = count_tokens(profile_texts)
+    by_length = sorted(range(len(profile_texts)), key=lambda index: token_counts[index])
+    bin_size = -(-len(by_length) // num_bins)  # Ceiling division
+    return [by_length[start:start + bin_size] for start in range(0, len(by_length), bin_size)]
+
+async def submit_batch(profiles, indices, requests_file):
+    """
+    Submits the profiles at `indices` as one Batch API job, polls until it
+    finishes and returns {index: classification text} for the requests that succeeded.
+    """
+    with open(requests_file, 'wb') as batch_file:
+        for index in indices:
+            _, profile_text = profiles[index]
+            request = {
+                # Index-based IDs keep the mapping unambiguous even if a patient ID repeats
+                "custom_id": f"profile-{index}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL_STRONG,
+                    "messages": [
+                        {"role": "system", "content": SYSTEM_PROMPT},
+                        {"role": "user", "content": build_prompt(profile_text)}
+                    ],
+                    "temperature": 0.0,
+                    "max_tokens": CLASSIFICATION_MAX_TOKENS,
+                    "response_format": CLASSIFICATION_RESPONSE_FORMAT,
+                    "prompt_cache_key": PROMPT_CACHE_KEY
+                }
+            }
+            batch_file.write(orjson.dumps(request) + b"\n")
+
+    with open(requests_file, 'rb') as batch_file:
+        uploaded = await client.files.create(file=batch_file, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"INFO: Submitted batch {batch.id} with {len(indices)} requests.")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await client.batches.retrieve(batch.id)
+        print(f"INFO: Batch {batch.id} status: {batch.status}")
+
+    classification_texts = {}
+    if batch.status != "completed" or not batch.output_file_id:
+        print(f"ERROR: Batch {batch.id} finished with status '{batch.status}'.")
+        return classification_texts
+
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        index = int(record["custom_id"].split("-")[1])
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            print(f"  !! Batch request {record['custom_id']} failed: {record.get('error')}")
+            continue
+        classification_texts[index] = response["body"]["choices"][0]["message"]["content"].strip()
+
+    return classification_texts
+
+async def run_batch_classification(profiles):
+    """
+    Classifies all profiles through the OpenAI Batch API.
+    Profiles are split into BATCH_LENGTH_BINS bins by token length and each bin
+    is submitted as its own batch (request file BATCH_REQUESTS_FILE with a bin
+    suffix). Returns the raw classification texts in the same order as
+    `profiles` (None for requests that failed).
+    """
+    if not profiles:
+        return []
+
+    bins = split_into_length_bins([profile_text for _, profile_text in profiles], BATCH_LENGTH_BINS)
+    requests_root, requests_ext = os.path.splitext(BATCH_REQUESTS_FILE)
+    bin_results = await asyncio.gather(*[
+        submit_batch(profiles, indices, f"{requests_root}_bin{bin_number}{requests_ext}")
+        for bin_number, indices in enumerate(bins, 1)
+    ])
+
+    # custom_ids carry the global profile index, so merging the bins is a lookup
+    classification_texts = [None] * len(profiles)
+    for results in bin_results:
+        for index, classification_text in results.items():
+            classification_texts[index] = classification_text
+    return classification_texts
+
+async def process_profiles():
+    """
+    Reads profiles from a CSV, gets ratings, and appends them to a JSONL file,
+    skipping patients already present from an earlier run.
+    Ratings are requested concurrently in groups of up to PROFILES_PER_REQUEST,
+    or through the Batch API if USE_BATCH_API is set.
+    This function is designed to handle CSVs where each patient's data spans multiple rows.
+    """
+    global client, response_cache
+
+    # Validate before creating the client or loading the heavier dependencies
+    if not os.path.exists(INPUT_FILE):
+        print(f"ERROR: Input file not found at '{INPUT_FILE}'. Please check the path and try again.")
+        return
+    if client is None:
+        client = create_client()
+    if USE_RESPONSE_CACHE and response_cache is None:
+        response_cache = ResponseCache(RESPONSE_CACHE_FILE)
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def load_cache():
+        """Helper coroutine that loads the classification cache on a worker thread."""
+        return await asyncio.to_thread(
+            ClassificationCache, CACHE_VECTORS_FILE, CACHE_ENTRIES_FILE, SEMANTIC_CACHE_THRESHOLD
+        )
+
+    async def classify_group(group):
+        """Helper coroutine to classify one group of complete patient profiles."""
+        async with semaphore:
+            for patient_id, _ in group:
+                print(f"Processing patient: {patient_id}...")
+            return await get_group_classification([profile_text for _, profile_text in group])
+
+    try:
+        # Make sure the output directory exists
         output_dir = os.path.dirname(OUTPUT_FILE)
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as outfile:
-            json.dump(all_results, outfile, indent=2)
+        # Parsing the CSV, scanning the existing JSONL output, loading the cache
+        # and loading the tokenizer (needed to truncate and meter every request)
+        # are independent startup steps, so they run on threads in parallel
+        print(f"INFO: Reading input file: {INPUT_FILE}")
+        patient_records, completed_ids, cache, _ = await asyncio.gather(
+            asyncio.to_thread(lambda: list(read_patient_profiles(INPUT_FILE))),
+            asyncio.to_thread(load_completed_ids, OUTPUT_FILE),
+            load_cache(),
+            asyncio.to_thread(get_tokenizer),
+        )
+
+        # Resume: patients already in the JSONL output from an earlier run are skipped
+        if completed_ids:
+            print(f"INFO: Resuming, {len(completed_ids)} patients already classified in {OUTPUT_FILE}")
+
+        # Identical profile texts are classified once; every patient ID sharing
+        # the text gets its own output record
+        patient_ids_by_text = defaultdict(list)
+        for patient_id, profile_text in patient_records:
+            if not patient_id or not profile_text.strip():
+                print(f"WARNING: Skipping patient record with incomplete data. ID: {patient_id}")
+                continue
+            if patient_id in completed_ids:
+                continue
+            patient_ids_by_text[profile_text].append(patient_id)
+
+        profiles = [(patient_ids[0], profile_text) for profile_text, patient_ids in patient_ids_by_text.items()]
+        patient_ids_per_profile = list(patient_ids_by_text.values())
+        duplicate_count = sum(len(patient_ids) for patient_ids in patient_ids_per_profile) - len(profiles)
+        if duplicate_count:
+            print(f"INFO: {duplicate_count} patients share an identical profile with another patient "
+                  f"and reuse its classification.")
+
+        written_count = 0
+        with open(OUTPUT_FILE, 'ab') as outfile:
+            # Terminate a line cut short by an interrupted run so new records start on their own line
+            if completed_ids and not output_ends_with_newline(OUTPUT_FILE):
+                outfile.write(b"\n")
+
+            def record_result(index, classification_text, source="model", cache_source=None):
+                """
+                Appends the classified patient(s) for one profile to the JSONL output as soon as it is available.
+                `source` says where the classification came from ("model", "exact cache" or
+                "semantic cache"); for a cache hit, `cache_source` identifies the cached profile.
+                """
+                nonlocal written_count
+                _, profile_text = profiles[index]
+                patient_ids = patient_ids_per_profile[index]
+                if not classification_text:
+                    print(f"WARNING: Failed to classify patient(s) {', '.join(patient_ids)}. Skipping.")
+                    return
+                barrier_list, difficulty_rating = parse_llm_output(classification_text)
+                for patient_id in patient_ids:
+                    outfile.write(orjson.dumps({
+                        "Patient ID": patient_id,
+                        "Patient Profile Summary": profile_text.strip(),
+                        "Barrier list": barrier_list,
+                        "Difficulty Level": difficulty_rating,
+                        "Classification Source": source,
+                        "Cache Source": cache_source,
+                    }) + b"\n")
+                outfile.flush()
+                written_count += len(patient_ids)
+
+            embeddings = [None] * len(profiles)
+            pending = list(range(len(profiles)))
+            if cache is not None:
+                pending = []
+                for index, (patient_id, profile_text) in enumerate(profiles):
+                    entry = cache.lookup_exact(profile_text)
+                    if entry:
+                        print(f"INFO: Exact cache hit for patient {patient_id}.")
+                        cache_source = {"Patient ID": entry.get("patient_id"), "SHA1": entry["sha1"]}
+                        record_result(index, entry["classification"], "exact cache", cache_source)
+                    else:
+                        pending.append(index)
+
+            # Embed every exact-cache miss up front, in a few batched requests
+            if cache is not None and USE_SEMANTIC_CACHE and pending:
+                try:
+                    pending_embeddings = await embed_profiles([profiles[index][1] for index in pending])
+                except Exception as e:
+                    print(f"  !! Embedding failed, skipping semantic cache: {e}")
+                else:
+                    still_pending = []
+                    for index, embedding in zip(pending, pending_embeddings):
+                        embeddings[index] = embedding
+                        hit = cache.lookup_similar(embedding)
+                        if hit:
+                            entry, similarity = hit
+                            print(f"INFO: Semantic cache hit for patient {profiles[index][0]} "
+                                  f"(from patient {entry.get('patient_id')}, similarity {similarity:.3f}).")
+                            cache_source = {
+                                "Patient ID": entry.get("patient_id"),
+                                "SHA1": entry["sha1"],
+                                "Similarity": round(similarity, 4),
+                            }
+                            record_result(index, entry["classification"], "semantic cache", cache_source)
+                        else:
+                            still_pending.append(index)
+                    pending = still_pending
 
-        print(f"\nSuccessfully processed {len(all_results)} profiles.")
-        print(f"Output saved to {OUTPUT_FILE}")
+            if USE_BATCH_API:
+                classification_texts = await run_batch_classification([profiles[index] for index in pending])
+                for index, classification_text in zip(pending, classification_texts):
+                    record_result(index, classification_text)
+                    if cache is not None and classification_text:
+                        cache.add(profiles[index][1], profiles[index][0], embeddings[index], classification_text)
+            else:
+                async def classify_and_record(group):
+                    """Classifies one group and writes its results before the other groups finish."""
+                    group_texts = await classify_group([profiles[index] for index in group])
+                    for index, classification_text in zip(group, group_texts):
+                        record_result(index, classification_text)
+                        if cache is not None and classification_text:
+                            cache.add(profiles[index][1], profiles[index][0], embeddings[index], classification_text)
+
+                # Only cache misses are sent to the model, several profiles per request.
+                # Sorting by length keeps long profiles from sharing a request with short ones.
+                pending.sort(key=lambda index: len(profiles[index][1]))
+                groups = [[pending[i] for i in group]
+                          for group in group_profiles([profiles[index][1] for index in pending])]
+                await asyncio.gather(*[classify_and_record(group) for group in groups])
+
+        if cache is not None:
+            cache.save()
+
+        # Downstream scripts read a single JSON array, so export one from the JSONL log
+        jsonl_to_json(OUTPUT_FILE, EXPORT_JSON_FILE)
+
+        print(f"\nSuccessfully processed {written_count} profiles.")
+        print(f"Output saved to {OUTPUT_FILE} (exported to {EXPORT_JSON_FILE})")
+        cascade_total = cascade_stats["fast"] + cascade_stats["escalated"]
+        if cascade_total:
+            print(f"Escalated {cascade_stats['escalated']}/{cascade_total} classifications "
+                  f"({cascade_stats['escalated'] / cascade_total:.0%}) from {MODEL_FAST} to {MODEL_STRONG}")
+        if response_cache is not None and response_cache.hits:
+            print(f"Served {response_cache.hits} requests from the response cache ({RESPONSE_CACHE_FILE})")
+        if token_usage["prompt_tokens"]:
+            print(f"Prompt tokens: {token_usage['prompt_tokens']} "
+                  f"({token_usage['cached_tokens']} served from the prompt cache)")
 
     except FileNotFoundError:
         print(f"ERROR: Input file not found at '{INPUT_FILE}'. Please check the path and try again.")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
+async def main():
+    try:
+        await process_profiles()
+    finally:
+        # Close the pooled connections explicitly rather than at interpreter exit
+        if client is not None:
+            await client.close()
+        if response_cache is not None:
+            response_cache.close()
+
 if __name__ == "__main__":
-    process_profiles()
+    asyncio.run(main())
@@ -7,29 +7,185 @@ Recreates a single-session, multi-turn role-play setup:
  - Therapist Agent: MI/CBT-consistent strategies.
 """
 
+import asyncio
+import functools
+import hashlib
 import json
+import logging
 import os
 import random
+import re
+import sqlite3
+import time
+import unicodedata
+import uuid
 from collections import Counter
-from datetime import datetime
-from typing import TypedDict, List, Literal, Dict, Any
+from typing import TypedDict, List, Literal, Dict, Any, Optional, Callable, Tuple
 
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph, END
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 # Load environment variables (OPENAI_API_KEY)
 load_dotenv()
 
-# Initialize OpenAI Client
-# NOTE: Using environment variables for security.
-# Ensure OPENAI_API_KEY is set in your .env file.
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Diagnostics and progress go through logging; the dialogue transcript itself is printed
+logger = logging.getLogger(__name__)
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s")
+    logger.setLevel(logging.INFO)
 
 # Model Configuration
-MODEL_PATIENT = "gpt-4o"
+# The patient mostly voices a fixed profile, so it runs on the smaller model; the
+# therapist turns are the SFT targets and keep the larger one. Each dialogue
+# carries its patient model in its state, so it can be overridden per dialogue.
+MODEL_PATIENT = "gpt-4o-mini"
 MODEL_THERAPIST = "gpt-4o"
 # Updated to valid model name format if needed
+# Auxiliary summarization is a simple extraction task, so it runs on the smaller model
+MODEL_SUMMARY = "gpt-4o-mini"
+
+# Output caps per call site, sized just above typical output lengths: a brief
+# patient reply plus a compact state summary as JSON, one therapist reply plus
+# its strategies line, and a one-paragraph profile summary. A tighter cap keeps
+# the server's reservation for each request small.
+MAX_TOKENS_PATIENT_TURN = 200
+MAX_TOKENS_THERAPIST_TURN = 400
+MAX_TOKENS_PROFILE_SUMMARY = 200
+
+# Turns per dialogue, counting patient and therapist turns alike
+MAX_TURNS = 60
+
+# Local token counting (tiktoken) keeps prompt plus output cap inside the context window
+TOKENIZER_ENCODING = "o200k_base"  # gpt-4o / gpt-4o-mini tokenizer
+CONTEXT_WINDOW_TOKENS = 128_000
+CONTEXT_SAFETY_MARGIN = 100  # Headroom for the chat message framing tokens
+
+# Upper bound on API requests in flight across all concurrently generated dialogues
+MAX_CONCURRENT_REQUESTS = 50
+request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Upper bound on dialogues in progress at once (SFT_BATCH_SIZE); the rest wait
+# instead of all holding state and sockets. The wavefront runner keeps this many
+# active, admitting the next profile as each dialogue ends; with USE_WAVEFRONT
+# off, independent dialogues wait on the semaphore instead
+MAX_CONCURRENT_DIALOGUES = int(os.getenv("SFT_BATCH_SIZE", "16"))
+dialogue_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DIALOGUES)
+
+# Open one pooled connection before the first wave of requests so it doesn't
+# start with a burst of parallel TLS handshakes (set SFT_WARM_UP=0 to skip)
+WARM_UP_CONNECTIONS = os.getenv("SFT_WARM_UP", "1") == "1"
+
+# Transient API errors (rate limits, timeouts, dropped connections) are retried
+# with randomized exponential backoff before a call is given up as failed.
+# The SDK's own retries are disabled so the two don't multiply.
+RETRY_POLICY = dict(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError)),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+# Initialize OpenAI Client
+# NOTE: Using environment variables for security.
+# Ensure OPENAI_API_KEY is set in your .env file.
+# The keep-alive pool holds a connection for every request allowed in flight.
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+        ),
+    ),
+)
+
+# Dialogues, caches and batch files are all written under OUTPUT_DIR, created once here
+OUTPUT_DIR = r"C:\Users\vikto\RecoveryBot Project"
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# Dialogues are saved as rows of one SQLite database in WAL mode rather than a
+# file each; set SFT_DEBUG_PRETTY=1 to also write indented JSON files for
+# reading by hand. The database also records which entries are done, so a
+# re-run only simulates the rest
+DIALOGUES_DB_FILE = r"C:\Users\vikto\RecoveryBot Project\SFT_Dialogues.db"
+DIALOGUE_COMMIT_INTERVAL = 32  # Dialogues inserted per commit
+DEBUG_PRETTY = os.getenv("SFT_DEBUG_PRETTY", "0") == "1"
+
+# Exact response cache: identical requests (same model, instructions, input,
+# output cap and format) are answered from an append-only JSONL file, across runs.
+# Requests are sampled at the default temperature, so a re-run with the cache on
+# replays the earlier dialogues instead of generating new ones; it is opt-in
+# (SFT_EXACT_CACHE=1) for resuming an interrupted run or iterating on prompts
+USE_EXACT_CACHE = os.getenv("SFT_EXACT_CACHE", "0") == "1"
+EXACT_CACHE_FILE = r"C:\Users\vikto\RecoveryBot Project\SFT_Exact_Response_Cache.jsonl"
+
+# Semantic response cache: reuse a stored response when a prompt's embedding is
+# near-identical (cosine similarity at or above the threshold) to one already answered.
+# Profile summaries and the patient's opening turn are matched on their whole
+# input; therapist turns are matched on the last THERAPIST_CACHE_TURNS messages
+# only, at the looser THERAPIST_CACHE_THRESHOLD, so a paraphrased patient turn
+# in a similar exchange reuses a reply (see call_llm). It is opt-in
+# (SEMANTIC_CACHE=1) so final data generation has no false hits
+USE_SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE") == "1"
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+THERAPIST_CACHE_TURNS = 3
+THERAPIST_CACHE_THRESHOLD = 0.9
+EMBEDDING_MAX_CHARS = 24000  # ~6k tokens, safely under the embedding model's 8k input limit
+# Concurrent embedding lookups (e.g. one per dialogue in a wavefront step) are
+# sent together: texts arriving within the window share one request of up to
+# EMBEDDING_BATCH_SIZE inputs (32 x ~6k tokens stays under the per-request limit)
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_BATCH_WINDOW_SECONDS = 0.01
+CACHE_VECTORS_FILE = r"C:\Users\vikto\RecoveryBot Project\SFT_Response_Cache.npy"
+CACHE_ENTRIES_FILE = r"C:\Users\vikto\RecoveryBot Project\SFT_Response_Cache.json"
+
+# Cache switches for prompt iteration: SFT_CACHE_SKIP=1 sends every request to
+# the API without reading either cache (fresh responses are still stored), and
+# SFT_CACHE_BUST=1 deletes both caches' files at startup
+CACHE_SKIP = os.getenv("SFT_CACHE_SKIP", "0") == "1"
+CACHE_BUST = os.getenv("SFT_CACHE_BUST", "0") == "1"
+if CACHE_BUST:
+    for cache_file in (EXACT_CACHE_FILE, CACHE_VECTORS_FILE, CACHE_ENTRIES_FILE):
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+# Offline generation can go through the OpenAI Batch API (~50% cheaper, no live
+# RPM/TPM throttling). Every dialogue advances one turn per batch, so a full run
+# takes one batch per turn and each batch can take up to 24h; the live path is
+# the default and the one to use for debugging.
+USE_BATCH_API = False
+
+# Server-side conversation state: with this set, each role's turns are chained
+# through the Responses API (previous_response_id), so after its first turn a
+# role only sends the other role's latest message instead of the whole
+# transcript. The chained input is still billed, but it's sent once per turn
+# rather than re-uploaded; the semantic response cache doesn't apply to chained turns.
+USE_CONVERSATION_STATE = False
+BATCH_POLL_SECONDS = 60
+BATCH_REQUESTS_FILE = r"C:\Users\vikto\RecoveryBot Project\SFT_Batch_Requests.jsonl"
+
+# Live dialogues advance in lockstep: each step sends the next turn of every
+# active dialogue together, so requests sharing the same instructions prefix
+# reach the API at the same time. With this off, each dialogue runs its own
+# loop independently.
+USE_WAVEFRONT = True
 
 
 # Therapeutic Strategies Catalogs
@@ -338,6 +494,49 @@ ACTIONABLE_TOOLS = [
 # Combine all lists so the therapist node can select from any of them
 ALL_STRATEGIES = MI_STRATEGIES + CBT_STRATEGIES + ACTIONABLE_TOOLS
 
+STRATEGY_CATALOGS = [
+    ("MI Strategies", MI_STRATEGIES),
+    ("CBT Strategies", CBT_STRATEGIES),
+    ("Actionable Tools", ACTIONABLE_TOOLS),
+]
+
+
+# Struct-of-arrays view of ALL_STRATEGIES: parallel tuples of ids, names and
+# descriptions, plus an id -> position index for O(1) lookup
+STRATEGY_IDS, STRATEGY_NAMES, STRATEGY_DESCRIPTIONS = (
+    tuple(column) for column in zip(*[(s["id"], s["name"], s["description"]) for s in ALL_STRATEGIES])
+)
+STRATEGY_INDEX_BY_ID = {strategy_id: index for index, strategy_id in enumerate(STRATEGY_IDS)}
+
+
+def get_strategy(strategy_id: str) -> Dict[str, str]:
+    """Returns the strategy with the given id."""
+    index = STRATEGY_INDEX_BY_ID[strategy_id]
+    return {
+        "id": strategy_id,
+        "name": STRATEGY_NAMES[index],
+        "description": STRATEGY_DESCRIPTIONS[index],
+    }
+
+
+def format_strategy_menu() -> str:
+    """
+    Formats every strategy as a numbered "name: description" line under its
+    catalog heading, numbering straight through ALL_STRATEGIES.
+    """
+    lines = []
+    start = 0
+    for title, catalog in STRATEGY_CATALOGS:
+        lines.append(f"{title}:")
+        for index in range(start, start + len(catalog)):
+            lines.append(f"{index + 1}. {STRATEGY_NAMES[index]}: {STRATEGY_DESCRIPTIONS[index]}")
+        start += len(catalog)
+    return "\n".join(lines)
+
+
+# Built once at import so the therapist prompt always matches the catalogs above
+_STRATEGY_MENU_TEXT = format_strategy_menu()
+
 # LangGraph State Definition
 
 
@@ -347,27 +546,44 @@ class DialogueState(TypedDict):
 
     Attributes:
         history: List of interaction dictionaries (role/content).
+        history_text: history rendered as a plain-text transcript for prompting, extended one line per turn;
+            once compacted, it opens with history_summary in place of the summarized turns.
+        history_tokens: Running token count of history_text, updated with each new line.
+        history_summary: Summary of the first summarized_turns messages of history.
+        summarized_turns: Number of leading history messages replaced by history_summary in history_text.
         patient_profile: String representation of the patient.
         patient_profile_summary: A concise summary of the patient profile.
-        difficulty: The set difficulty level (easy/medium/hard).
-        difficulty_description: Instructions on resistance level.
+        difficulty: The set difficulty level (easy/medium/hard), a key of DIFFICULTY_DESCRIPTIONS.
+        patient_model: Model that plays the patient (MODEL_PATIENT unless overridden).
         max_turns: Target total turns.
         turn_index: Current 0-based turn count.
         strategy_history: List of strategy IDs used so far.
+        strategy_counts: Running count of each strategy in strategy_history.
+        strategy_usage_text: strategy_counts formatted for the therapist prompt.
         patient_resolution_status: Boolean indicating if the patient has achieved resolution.
         patient_state_summary: A summary of the patient's state.
+        patient_response_id: Last Responses API ID of the patient's chain (USE_CONVERSATION_STATE).
+        therapist_response_id: Last Responses API ID of the therapist's chain (USE_CONVERSATION_STATE).
     """
 
     history: List[Dict[str, str]]
+    history_text: str
+    history_tokens: int
+    history_summary: str
+    summarized_turns: int
     patient_profile: str
     patient_profile_summary: str
     difficulty: Literal["easy", "medium", "hard"]
-    difficulty_description: str
+    patient_model: str
     max_turns: int
     turn_index: int
     strategy_history: List[str]
+    strategy_counts: Counter
+    strategy_usage_text: str
     patient_resolution_status: bool
     patient_state_summary: str
+    patient_response_id: Optional[str]
+    therapist_response_id: Optional[str]
 
 
 DIFFICULTY_DESCRIPTIONS = {
@@ -390,50 +606,427 @@ DIFFICULTY_DESCRIPTIONS = {
 }
 
 
-def summarize_patient_profile(profile: str) -> str:
+PROFILE_SUMMARY_INSTRUCTIONS = (
+    "Summarize the following patient profile into a concise paragraph. "
+    "Focus on the key clinical details: primary issue, substance use history, "
+    "behavioral patterns, and motivations. This summary will be used by a therapist bot "
+    "to maintain context during a conversation."
+)
+
+
+def build_summary_request(profile: str) -> Dict[str, Any]:
+    """Returns the call_llm arguments for summarizing a patient profile."""
+    return {
+        "model": MODEL_SUMMARY,
+        "instructions": PROFILE_SUMMARY_INSTRUCTIONS,
+        "input_text": profile,
+        "max_output_tokens": MAX_TOKENS_PROFILE_SUMMARY,
+    }
+
+
+async def summarize_patient_profile(profile: str) -> str:
     """
     Uses an LLM to create a concise summary of the patient profile.
     """
-    instructions = (
-        "Summarize the following patient profile into a concise paragraph. "
-        "Focus on the key clinical details: primary issue, substance use history, "
-        "behavioral patterns, and motivations. This summary will be used by a therapist bot "
-        "to maintain context during a conversation."
-    )
-    summary = call_llm(
-        model=MODEL_THERAPIST,
-        instructions=instructions,
-        input_text=profile,
-        max_output_tokens=256,
-    )
-    return summary
+    return await call_llm(**build_summary_request(profile), semantic_cache=True)
+
 
+class ExactResponseCache:
+    """
+    Exact-match cache of LLM responses, keyed on a SHA-256 of the whole request.
+    Prompt text is NFC-normalized before hashing, so composed and decomposed
+    forms of the same characters share an entry.
+    Persisted as an append-only JSONL file of {"key": ..., "response": ...} records.
+    """
 
-def call_llm(model: str, instructions: str, input_text: str, max_output_tokens: int = 256) -> str:
+    def __init__(self, path: str):
+        self.path = path
+        self.responses: Dict[str, str] = {}
+        self.hits = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        record = orjson.loads(line)
+                        self.responses[record["key"]] = record["response"]
+
+    @staticmethod
+    def request_key(
+        model: str,
+        instructions: str,
+        input_text: str,
+        max_output_tokens: int,
+        response_format: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        # Stays on the stdlib encoder: a different serialization would change
+        # every key and orphan the responses already in the cache file
+        instructions = unicodedata.normalize("NFC", instructions)
+        input_text = unicodedata.normalize("NFC", input_text)
+        payload = json.dumps([model, instructions, input_text, max_output_tokens, response_format], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        response = self.responses.get(key)
+        if response is not None:
+            self.hits += 1
+        return response
+
+    def add(self, key: str, response: str):
+        self.responses[key] = response
+        with open(self.path, "ab") as f:
+            f.write(orjson.dumps({"key": key, "response": response}) + b"\n")
+
+
+exact_cache = ExactResponseCache(EXACT_CACHE_FILE) if USE_EXACT_CACHE else None
+
+
+class SemanticResponseCache:
     """
-    Thin wrapper around the OpenAI Chat Completions API with error handling.
+    Semantic cache of LLM responses.
+    Prompts are partitioned by model, output cap and system instructions, and
+    only the user input is embedded; hits use inner product over L2-normalized
+    embeddings (i.e. cosine similarity), searched with FAISS when it is installed.
+    Persisted as a .npy matrix of vectors plus a parallel JSON list of entries.
     """
+
+    def __init__(self, vectors_file: str, entries_file: str, threshold: float):
+        self.vectors_file = vectors_file
+        self.entries_file = entries_file
+        self.threshold = threshold
+        self.partitions: Dict[str, Dict[str, Any]] = {}
+        self.hits = 0
+        try:
+            import faiss
+        except ImportError:
+            faiss = None  # Fall back to a NumPy dot-product search
+        self.faiss = faiss
+
+        if os.path.exists(vectors_file) and os.path.exists(entries_file):
+            vectors = np.load(vectors_file)
+            with open(entries_file, "rb") as f:
+                entries = orjson.loads(f.read())
+            # Rows are loaded one block per partition rather than one vector at a time
+            rows_by_partition: Dict[str, List[int]] = {}
+            for row, entry in enumerate(entries):
+                rows_by_partition.setdefault(entry["partition"], []).append(row)
+            for partition, rows in rows_by_partition.items():
+                self.add_many(partition, vectors[rows], [entries[row]["response"] for row in rows])
+
+    @staticmethod
+    def partition_key(model: str, max_output_tokens: int, instructions: str) -> str:
+        instructions_hash = hashlib.sha1(instructions.encode("utf-8")).hexdigest()
+        return f"{model}|{max_output_tokens}|{instructions_hash}"
+
+    def lookup(self, partition: str, embedding: np.ndarray, threshold: Optional[float] = None) -> Optional[str]:
+        """Returns the nearest stored response if its similarity reaches threshold (self.threshold by default)."""
+        part = self.partitions.get(partition)
+        if part is None:
+            return None
+        if part["index"] is not None:
+            scores, ids = part["index"].search(embedding.reshape(1, -1), 1)
+            best_score, best_id = scores[0, 0], ids[0, 0]
+        else:
+            similarities = part["matrix"][:len(part["vectors"])] @ embedding
+            best_id = int(np.argmax(similarities))
+            best_score = similarities[best_id]
+        if best_score >= (self.threshold if threshold is None else threshold):
+            self.hits += 1
+            return part["responses"][best_id]
+        return None
+
+    def add(self, partition: str, embedding: np.ndarray, response: str):
+        self.add_many(partition, embedding.reshape(1, -1), [response])
+
+    def add_many(self, partition: str, embeddings: np.ndarray, responses: List[str]):
+        """Adds one response per row of embeddings with a single index or matrix update."""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        part = self.partitions.get(partition)
+        if part is None:
+            index = self.faiss.IndexFlatIP(embeddings.shape[1]) if self.faiss is not None else None
+            part = self.partitions[partition] = {"vectors": [], "responses": [], "index": index, "matrix": None}
+        if part["index"] is not None:
+            part["index"].add(embeddings)
+        else:
+            # Without FAISS, vectors are kept in one preallocated matrix that
+            # doubles when full, so a lookup doesn't restack every vector
+            size, matrix = len(part["vectors"]), part["matrix"]
+            needed = size + len(embeddings)
+            if matrix is None or needed > matrix.shape[0]:
+                grown = np.empty((max(16, 2 * needed), embeddings.shape[1]), dtype=np.float32)
+                if matrix is not None:
+                    grown[:size] = matrix[:size]
+                part["matrix"] = matrix = grown
+            matrix[size:needed] = embeddings
+        part["vectors"].extend(embeddings)
+        part["responses"].extend(responses)
+
+    def save(self):
+        vectors, entries = [], []
+        for partition, part in self.partitions.items():
+            vectors.extend(part["vectors"])
+            entries.extend({"partition": partition, "response": response} for response in part["responses"])
+        if not vectors:
+            return
+        np.save(self.vectors_file, np.vstack(vectors))
+        with open(self.entries_file, "wb") as f:
+            f.write(orjson.dumps(entries))
+
+
+response_cache = (
+    SemanticResponseCache(CACHE_VECTORS_FILE, CACHE_ENTRIES_FILE, SEMANTIC_CACHE_THRESHOLD)
+    if USE_SEMANTIC_CACHE else None
+)
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding lookups into batched embeddings requests.
+    A batch is sent once EMBEDDING_BATCH_SIZE texts are waiting or
+    EMBEDDING_BATCH_WINDOW_SECONDS after its first text arrived.
+    """
+
+    def __init__(self):
+        self.pending: List[Tuple[str, asyncio.Future]] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.requests = set()  # Running batch requests, referenced until they finish
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= EMBEDDING_BATCH_SIZE:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(EMBEDDING_BATCH_WINDOW_SECONDS, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            request = asyncio.ensure_future(self._request(batch))
+            self.requests.add(request)
+            request.add_done_callback(self.requests.discard)
+
+    async def _request(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = [text[-EMBEDDING_MAX_CHARS:] for text, _ in batch]
+        try:
+            async for attempt in AsyncRetrying(**RETRY_POLICY):
+                with attempt:
+                    async with request_semaphore:
+                        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+            data = sorted(response.data, key=lambda item: item.index)
+            embeddings = np.asarray([item.embedding for item in data], dtype=np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        except Exception as e:
+            logger.warning("Embedding failed, skipping the semantic cache: %s", e)
+            embeddings = [None] * len(batch)
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+
+embedding_batcher = EmbeddingBatcher()
+
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    """
+    Returns the L2-normalized float32 embedding of text, or None if the request fails.
+    Over-long text keeps its tail, where the latest turns of a transcript are.
+    Concurrent calls share batched requests through embedding_batcher.
+    """
+    return await embedding_batcher.embed(text)
+
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    """
+    Returns the TOKENIZER_ENCODING tiktoken encoding, or None if it cannot be loaded.
+    """
+    import tiktoken
+
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": instructions},
-                {"role": "user", "content": input_text},
-            ],
-            max_tokens=max_output_tokens,
-        )
-        return response.choices[0].message.content.strip()
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # The encoding is downloaded on first use; estimate ~4 characters per token without it
+        logger.warning("Could not load the %s tokenizer, estimating token counts: %s", TOKENIZER_ENCODING, e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Returns the token count of text."""
+    encoding = get_tokenizer()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+@functools.lru_cache(maxsize=None)
+def count_instruction_tokens(instructions: str) -> int:
+    """Token count of a system prompt; the static prompts are counted once."""
+    return count_tokens(instructions)
+
+
+def fit_output_tokens(instructions: str, input_text: str, max_output_tokens: int) -> int:
+    """
+    Caps max_output_tokens so the prompt plus the output fits in the context window.
+    """
+    headroom = CONTEXT_WINDOW_TOKENS - CONTEXT_SAFETY_MARGIN - max_output_tokens - count_instruction_tokens(instructions)
+    # Every token is at least one byte, so the UTF-8 length bounds the input's
+    # token count; only a prompt near the window is actually tokenized, and the
+    # profile and transcript aren't re-encoded on every turn
+    if len(input_text.encode("utf-8")) <= headroom:
+        return max_output_tokens
+    used = count_instruction_tokens(instructions) + count_tokens(input_text)
+    return max(1, min(max_output_tokens, CONTEXT_WINDOW_TOKENS - used - CONTEXT_SAFETY_MARGIN))
+
+
+async def call_llm(
+    model: str,
+    instructions: str,
+    input_text: str,
+    max_output_tokens: int = 256,
+    response_format: Optional[Dict[str, Any]] = None,
+    stream_until: Optional[Callable[[str], bool]] = None,
+    prompt_cache_key: Optional[str] = None,
+    semantic_cache: bool = False,
+    semantic_text: Optional[str] = None,
+    semantic_threshold: Optional[float] = None,
+) -> str:
+    """
+    Thin wrapper around the async OpenAI Chat Completions API with error handling.
+    At most MAX_CONCURRENT_REQUESTS calls are in flight at once, and transient
+    errors are retried according to RETRY_POLICY.
+    Repeated prompts are answered from the exact response cache, unless CACHE_SKIP is set.
+    Callers set `semantic_cache` only for requests whose answer may be reused
+    for a near-duplicate prompt: profile summaries and the patient's opening
+    turn (the therapist never speaks first, so none of its requests has an empty
+    history). Mid-dialogue prompts differ only in their newest lines, so a
+    semantic hit on the whole input would replay an earlier turn; those callers
+    pass `semantic_text`, the recent turns to match on instead, kept in a
+    partition of their own and compared at `semantic_threshold`.
+    If `stream_until` is given, the response is streamed and the stream is
+    closed as soon as stream_until(text_so_far) is true, so generation stops early.
+    `prompt_cache_key` routes requests sharing a prompt prefix to the same
+    prompt cache; it doesn't affect the output, so it's not part of the cache keys.
+    """
+    exact_key = None
+    if exact_cache is not None:
+        exact_key = exact_cache.request_key(model, instructions, input_text, max_output_tokens, response_format)
+        cached = None if CACHE_SKIP else exact_cache.get(exact_key)
+        if cached is not None:
+            return cached
+
+    partition = embedding = None
+    if response_cache is not None and semantic_cache:
+        partition = response_cache.partition_key(model, max_output_tokens, instructions)
+        if semantic_text is not None:
+            partition += "|recent-turns"
+        embedding = await embed_text(input_text if semantic_text is None else semantic_text)
+        if embedding is not None and not CACHE_SKIP:
+            cached = response_cache.lookup(partition, embedding, semantic_threshold)
+            if cached is not None:
+                return cached
+
+    # Only send response_format and prompt_cache_key when a caller sets them
+    extra_args = {"response_format": response_format} if response_format else {}
+    if prompt_cache_key:
+        extra_args["prompt_cache_key"] = prompt_cache_key
+    max_output_tokens = fit_output_tokens(instructions, input_text, max_output_tokens)
+    messages = [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": input_text},
+    ]
+    try:
+        async for attempt in AsyncRetrying(**RETRY_POLICY):
+            with attempt:
+                # The semaphore is held per attempt, so backoff waits don't block other calls
+                async with request_semaphore:
+                    if stream_until is None:
+                        response = await client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=max_output_tokens,
+                            **extra_args,
+                        )
+                        content = response.choices[0].message.content.strip()
+                    else:
+                        stream = await client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=max_output_tokens,
+                            stream=True,
+                            **extra_args,
+                        )
+                        text = ""
+                        try:
+                            async for chunk in stream:
+                                if chunk.choices and chunk.choices[0].delta.content:
+                                    text += chunk.choices[0].delta.content
+                                    if stream_until(text):
+                                        break
+                        finally:
+                            await stream.close()
+                        content = text.strip()
+        if exact_key is not None:
+            exact_cache.add(exact_key, content)
+        if embedding is not None:
+            response_cache.add(partition, embedding, content)
+        return content
     except Exception as e:
-        # Print the error and return a placeholder message
-        print(f"\n--- ERROR DURING API CALL ---")
-        print(f"Failed to generate response using model {model}.")
-        print(f"Error details: {e}\n")
+        # Log the error (after retries, if it was transient) and return a placeholder message
+        logger.error("API call failed for model %s: %s", model, e)
 
-        # Returning a placeholder ensures the graph doesn't crash
+        # Returning a placeholder ensures the dialogue doesn't crash
         # but marks the failure clearly in the history.
         return f"[API_FAILURE: {type(e).__name__}]"
 
 
+async def call_llm_chained(
+    model: str,
+    instructions: str,
+    input_text: str,
+    previous_response_id: Optional[str],
+    max_output_tokens: int = 256,
+    response_format: Optional[Dict[str, Any]] = None,
+    prompt_cache_key: Optional[str] = None,
+) -> Tuple[str, Optional[str]]:
+    """
+    Like call_llm, but through the Responses API with server-side conversation
+    state: previous_response_id links input_text to the earlier turns of the
+    chain, so only the new input is sent.
+    Returns the response text and its ID; on failure the ID is None, so the
+    next turn starts a new chain.
+    """
+    extra_args = {}
+    if previous_response_id is not None:
+        extra_args["previous_response_id"] = previous_response_id
+    if prompt_cache_key:
+        extra_args["prompt_cache_key"] = prompt_cache_key
+    if response_format:
+        # The Responses API takes the Chat Completions json_schema fields flattened
+        extra_args["text"] = {"format": {"type": "json_schema", **response_format["json_schema"]}}
+    try:
+        async for attempt in AsyncRetrying(**RETRY_POLICY):
+            with attempt:
+                async with request_semaphore:
+                    response = await client.responses.create(
+                        model=model,
+                        instructions=instructions,
+                        input=input_text,
+                        max_output_tokens=max_output_tokens,
+                        **extra_args,
+                    )
+        return response.output_text.strip(), response.id
+    except Exception as e:
+        # Log the error and return a placeholder message
+        logger.error("API call failed for model %s: %s", model, e)
+        return f"[API_FAILURE: {type(e).__name__}]", None
+
+
 def render_history_for_prompt(history: List[Dict[str, str]]) -> str:
     """
     Turn internal history into a plain-text transcript for prompting.
@@ -445,64 +1038,252 @@ def render_history_for_prompt(history: List[Dict[str, str]]) -> str:
     return "\n".join(lines)
 
 
-# Patient Node Logic
+def append_history_text(history_text: str, role: str, content: str) -> str:
+    """
+    Appends one message to a transcript rendered by render_history_for_prompt,
+    so the transcript grows with each turn instead of being rebuilt.
+    """
+    line = f"{'Patient' if role == 'patient' else 'Therapist'}: {content}"
+    return f"{history_text}\n{line}" if history_text else line
 
 
-def patient_node(state: DialogueState) -> Dict[str, Any]:
+def extend_history_text(state: DialogueState, role: str, content: str) -> Dict[str, Any]:
     """
-    Generates the patient's next utterance, summary, and resolution status in a single call.
+    Returns the history_text and history_tokens updates for one new message.
+    Only the added line is tokenized, not the whole transcript.
     """
-    history_text = render_history_for_prompt(state["history"])
-    display_history = history_text if history_text else "(no prior conversation – this is the first turn)"
+    history_text = append_history_text(state["history_text"], role, content)
+    added_tokens = count_tokens(history_text[len(state["history_text"]):])
+    return {"history_text": history_text, "history_tokens": state["history_tokens"] + added_tokens}
+
+
+# Once the prompt transcript passes HISTORY_TOKEN_BUDGET tokens, the older half
+# of its turns is folded into a running summary from MODEL_SUMMARY, so prompt
+# length levels off instead of growing with every turn. Only history_text is
+# compacted; history, the saved dialogue, stays complete. The summary request
+# runs alongside the turn's own request, and the compacted transcript is used
+# from the next turn on, so compaction never delays a turn.
+HISTORY_TOKEN_BUDGET = 3000
+MAX_TOKENS_HISTORY_SUMMARY = 300
+
+HISTORY_SUMMARY_INSTRUCTIONS = (
+    "Summarize the following dialogue turns between a patient and a therapist into a concise paragraph, "
+    "preserving the patient's emotions and every fact they disclosed. If an earlier summary is given, "
+    "fold it into the new one."
+)
+
+
+async def summarize_older_turns(state: DialogueState) -> Dict[str, Any]:
+    """
+    Returns the new history_summary and summarized_turns if history_text has
+    grown past HISTORY_TOKEN_BUDGET (going by the running history_tokens count,
+    so the transcript isn't re-tokenized every turn), or an empty dict if it hasn't or the
+    summary request fails. apply_compaction folds the result into a node's update.
+    """
+    if state["history_tokens"] <= HISTORY_TOKEN_BUDGET:
+        return {}
+    history = state["history"]
+    start = state["summarized_turns"]
+    end = start + (len(history) - start) // 2
+    if end == start:
+        return {}
+
+    input_text = render_history_for_prompt(history[start:end])
+    if state["history_summary"]:
+        input_text = f"Earlier summary:\n{state['history_summary']}\n\nTurns:\n{input_text}"
+    history_summary = await call_llm(
+        model=MODEL_SUMMARY,
+        instructions=HISTORY_SUMMARY_INSTRUCTIONS,
+        input_text=input_text,
+        max_output_tokens=MAX_TOKENS_HISTORY_SUMMARY,
+    )
+    if history_summary.startswith("[API_FAILURE"):
+        return {}
+    return {"history_summary": history_summary, "summarized_turns": end}
+
+
+def apply_compaction(update: Dict[str, Any], compaction: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Adds a summarize_older_turns result to a node's state update, rebuilding
+    history_text as the summary followed by the turns it doesn't cover,
+    including the one the node just added.
+    """
+    if not compaction:
+        return update
+    recent_text = render_history_for_prompt(update["history"][compaction["summarized_turns"]:])
+    history_text = f"(Summary of the earlier conversation: {compaction['history_summary']})\n{recent_text}"
+    return {**update, **compaction, "history_text": history_text, "history_tokens": count_tokens(history_text)}
+
+
+# Patient Node Logic
 
-    instructions_for_json_output = """
+# Structured output: the patient's reply and state summary come back from one
+# call as a JSON object guaranteed to match this schema
+PATIENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "patient_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "reply": {"type": "string"},
+                "summary": {"type": "string"},
+            },
+            "required": ["reply", "summary"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Patient turns that don't refresh the state summary ask for the reply alone,
+# with a smaller output cap
+PATIENT_REPLY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "patient_reply_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"reply": {"type": "string"}},
+            "required": ["reply"],
+            "additionalProperties": False,
+        },
+    },
+}
+MAX_TOKENS_PATIENT_REPLY_TURN = 120
+
+# The state summary is refreshed on every STATE_SUMMARY_INTERVAL-th patient
+# turn (the first included) and carried over in between; the refreshing turn
+# sees the full transcript, so it covers the turns since the last refresh.
+# The dialogue's last turn never refreshes it, since nothing reads it afterwards.
+STATE_SUMMARY_INTERVAL = 3
+
+# Closure language that ends the session. The patient is told to use it only once
+# motivated and committed, so detecting it locally replaces a model-judged flag.
+RESOLUTION_RE = re.compile(
+    r"\b(?:good-?bye|bye for now|take care|see you (?:next|soon|then)|talk (?:to you )?(?:next|soon)"
+    r"|(?:we(?:'|’)ve|we have) covered (?:everything|a lot)|(?:that|this|you(?:'|’)ve) (?:really )?helped( me)? a lot"
+    r"|i(?:'|’)ll (?:give (?:it|that|this) a (?:try|shot)|commit to)|i(?:'|’)m ready to (?:try|start|commit))\b",
+    re.IGNORECASE,
+)
+
+PATIENT_INSTRUCTIONS = """
 You are role-playing as a patient in addiction recovery.
 Speak from the profile below, staying consistent with the conversation so far.
 Your difficulty level description explains how resistant or ambivalent you are.
 
-Your task is to generate a single JSON object containing three fields: "reply", "summary", and "resolution_status".
+Your task is to generate a single JSON object containing two fields: "reply" and "summary".
 
 1.  **reply**: Create the patient's next utterance based on the conversation history and their profile. This should be a natural, brief response in the patient's voice. Do not include narration or system messages.
 2.  **summary**: Analyze the patient's message and the current situation to provide a compact summary of their state. This summary should cover aspects like craving levels, trigger salience, confidence, and any flags for recent lapses.
-3.  **resolution_status**: Analyze the patient's message for indications that the session is complete. If the patient expresses sufficient motivation, confidence, and commitment to try a therapy micro-assignment, AND uses language that signals closure or readiness to end the dialogue (e.g., 'See you next time', 'I think we’ve covered everything', 'That helped a lot'), set this to `true`. Otherwise, set it to `false`.
+
+Only once the patient has sufficient motivation, confidence, and commitment to try a therapy micro-assignment, end the reply with language that signals closure (e.g., 'See you next time', 'I think we’ve covered everything', 'That helped a lot'). Do not use such language before then.
 
 The final output MUST be a valid JSON object and nothing else.
 """
 
-    prompt = f"""
-Patient Profile:
-{state['patient_profile']}
+# The difficulty description is shared by every dialogue of that difficulty, so
+# it goes in the system message after the static instructions. That makes the
+# instructions plus difficulty a prefix common to all of those dialogues, ahead
+# of the per-dialogue profile and transcript in the user message.
+PATIENT_INSTRUCTIONS_BY_DIFFICULTY = {
+    difficulty: f"{PATIENT_INSTRUCTIONS}\nDifficulty Setting:\n{description}\n"
+    for difficulty, description in DIFFICULTY_DESCRIPTIONS.items()
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def dialogue_cache_key(patient_profile: str) -> str:
+    """
+    The prompt_cache_key for one dialogue's requests. Every turn of a dialogue
+    repeats the same profile-led prefix, so sending them under one key keeps
+    them on the same prompt cache.
+    """
+    return hashlib.sha1(patient_profile.encode("utf-8")).hexdigest()[:16]
+
+
+def is_final_turn(state: DialogueState) -> bool:
+    """True if the next turn reaches max_turns and so ends the dialogue."""
+    return state["turn_index"] + 1 >= state["max_turns"]
 
-Difficulty Setting:
-{state['difficulty_description']}
+
+def refreshes_state_summary(state: DialogueState) -> bool:
+    """True if the patient's next turn also produces a new state summary."""
+    # Patient turns fall on even turn indices
+    patient_turn = state["turn_index"] // 2
+    return not is_final_turn(state) and patient_turn % STATE_SUMMARY_INTERVAL == 0
+
+
+def patient_request_fields(state: DialogueState) -> str:
+    """The JSON fields the patient's next turn asks for, as prompt text."""
+    return '"reply" and "summary"' if refreshes_state_summary(state) else '"reply"'
+
+
+@functools.lru_cache(maxsize=1024)
+def patient_prompt_head(patient_profile: str) -> str:
+    """
+    The profile-led opening of the patient's user message, which is the same on
+    every turn of a dialogue, so it's formatted once per profile.
+    """
+    return f"""
+Patient Profile:
+{patient_profile}
 
 Conversation So Far:
-{display_history}
+"""
+
+
+def build_patient_request(state: DialogueState) -> Dict[str, Any]:
+    """Returns the call_llm arguments for the patient's next turn."""
+    if refreshes_state_summary(state):
+        response_format = PATIENT_RESPONSE_FORMAT
+        max_output_tokens = MAX_TOKENS_PATIENT_TURN
+    else:
+        response_format = PATIENT_REPLY_RESPONSE_FORMAT
+        max_output_tokens = MAX_TOKENS_PATIENT_REPLY_TURN
+
+    history_text = state["history_text"]
+    display_history = history_text if history_text else "(no prior conversation – this is the first turn)"
+
+    prompt = f"""{patient_prompt_head(state['patient_profile'])}{display_history}
 
-Based on the above, provide the next patient turn as a JSON object with "reply", "summary", and "resolution_status".
+Based on the above, provide the next patient turn as a JSON object with {patient_request_fields(state)}.
 """
 
-    response_str = call_llm(
-        model=MODEL_PATIENT,
-        instructions=instructions_for_json_output,
-        input_text=prompt,
-        max_output_tokens=256,  # Increased to accommodate JSON structure and content
-    )
+    return {
+        "model": state["patient_model"],
+        "instructions": PATIENT_INSTRUCTIONS_BY_DIFFICULTY[state["difficulty"]],
+        "input_text": prompt,
+        "max_output_tokens": max_output_tokens,
+        "response_format": response_format,
+        "prompt_cache_key": f"patient-{dialogue_cache_key(state['patient_profile'])}",
+    }
+
 
+def apply_patient_response(state: DialogueState, response_str: str) -> Dict[str, Any]:
+    """
+    Parses the patient's JSON response into a state update. The resolution
+    status is detected locally from closure language in the reply.
+    Between summary refreshes the previous state summary is kept. On the final
+    turn the dialogue ends regardless, so the resolution check is skipped.
+    """
     try:
-        # The response might be enclosed in markdown ```json ... ```
-        if response_str.startswith("```json"):
-            response_str = response_str[7:-4]
-
-        response_data = json.loads(response_str)
-        patient_reply = response_data.get("reply", "[MISSING_REPLY]")
-        patient_state_summary = response_data.get("summary", "[MISSING_SUMMARY]")
-        patient_resolution_status = response_data.get("resolution_status", False)
-    except (json.JSONDecodeError, AttributeError) as e:
-        print(f"--- ERROR PARSING PATIENT JSON RESPONSE ---")
-        print(f"Failed to parse JSON: {e}")
-        print(f"Raw response: {response_str}")
-        # Provide fallback values to avoid crashing the graph
+        response_data = orjson.loads(response_str)
+        patient_reply = response_data["reply"]
+        if refreshes_state_summary(state):
+            patient_state_summary = response_data["summary"]
+        else:
+            patient_state_summary = state["patient_state_summary"]
+        # The opening turn can't close a session that hasn't happened yet
+        patient_resolution_status = (
+            state["turn_index"] > 0 and not is_final_turn(state)
+            and bool(RESOLUTION_RE.search(patient_reply))
+        )
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        # Only an API failure placeholder or a truncated response ends up here
+        logger.error("Failed to parse patient JSON response (%s). Raw response: %s", e, response_str)
+        # Provide fallback values to avoid crashing the dialogue
         patient_reply = response_str  # Use the raw string as a fallback for the reply
         patient_state_summary = "Error parsing patient state."
         patient_resolution_status = False
@@ -512,46 +1293,51 @@ Based on the above, provide the next patient turn as a JSON object with "reply",
 
     return {
         "history": new_history,
+        **extend_history_text(state, "patient", patient_reply),
         "turn_index": new_turn_index,
         "patient_state_summary": patient_state_summary,
         "patient_resolution_status": patient_resolution_status,
     }
 
 
-# Therapist Node Logic
-
-
-def therapist_node(state: DialogueState) -> Dict[str, Any]:
+async def patient_node(state: DialogueState) -> Dict[str, Any]:
     """
-    Generates the therapist's response using a summarized profile and strategy names to save tokens.
+    Generates the patient's next utterance and summary in a single call,
+    compacting the transcript alongside if it has grown past HISTORY_TOKEN_BUDGET.
+    With USE_CONVERSATION_STATE, a patient chain that is already under way
+    only receives the therapist's latest message.
     """
-    history_text = render_history_for_prompt(state["history"])
+    if not USE_CONVERSATION_STATE:
+        compaction, response_str = await asyncio.gather(
+            summarize_older_turns(state),
+            call_llm(**build_patient_request(state), semantic_cache=not state["history"]),
+        )
+        return apply_compaction(apply_patient_response(state, response_str), compaction)
+
+    request = build_patient_request(state)
+    previous_response_id = state["patient_response_id"]
+    if previous_response_id is not None:
+        request["input_text"] = (
+            f"Therapist: {state['history'][-1]['content']}\n\n"
+            f"Provide the next patient turn as a JSON object with {patient_request_fields(state)}."
+        )
+    response_str, response_id = await call_llm_chained(previous_response_id=previous_response_id, **request)
+    return {**apply_patient_response(state, response_str), "patient_response_id": response_id}
 
-    # Track strategy usage
-    strategy_counts = Counter(state["strategy_history"])
-    strategy_usage_text = "\n".join(
-        [f"- {strategy}: {count} times used." for strategy, count in strategy_counts.items()]
-    )
-    if not strategy_usage_text:
-        strategy_usage_text = "No strategies used yet."
 
-    def get_strategy_names(strategy_list: List[Dict[str, str]]) -> str:
-        return ", ".join([f'"{item["name"]}"' for item in strategy_list])
+# Therapist Node Logic
+
 
-    therapist_instructions_template = """
+# The therapist instructions are identical on every turn of every dialogue, so
+# they are formatted once and sent verbatim as the leading system message; that
+# byte-identical prefix is what OpenAI's automatic prompt caching reuses.
+# Everything that changes per dialogue or per turn goes in the user message.
+THERAPIST_STATIC_INSTRUCTIONS = """
 You are an expert therapist in a role-play simulation. Your goal is to conduct a therapeutic dialogue with a patient based on their profile summary.
 You should be empathetic, non-judgmental, and collaborative.
 
-PATIENT SUMMARY:
-{user_analysis}
-
-STRATEGY USAGE:
-{strategy_usage}
-
 AVAILABLE STRATEGIES:
-- MI Strategies: {MI_STRATEGIES}
-- CBT Strategies: {CBT_STRATEGIES}
-- Actionable Tools: {ACTIONABLE_TOOLS}
+{strategy_menu}
 
 INSTRUCTIONS:
 1. Read the patient summary and conversation history carefully.
@@ -559,6 +1345,7 @@ INSTRUCTIONS:
 3. Ask open-ended questions to explore the patient's challenges, motivations, and triggers.
 4. Build rapport using affirmations and reflective listening.
 5. If you suggest a coping mechanism or tool, refer to the "Actionable Tools" list.
+   When you list the strategies you used, give their names exactly as in the lists above.
 6. Keep your response concise and natural.
 7. Write the therapist's next reply only. Do not include 'Therapist:' labels or any narration.
 
@@ -583,36 +1370,69 @@ it during specific times of day or situations?
 
 After your response, you MUST list the strategies you used on a new line. Use the format:
 **Strategies:** Strategy Name 1, Strategy Name 2
+""".format(strategy_menu=_STRATEGY_MENU_TEXT)
+
+
+def format_strategy_usage(strategy_counts: Counter) -> str:
+    """Formats the strategy counts for the therapist prompt."""
+    if not strategy_counts:
+        return "No strategies used yet."
+    return "\n".join([f"- {strategy}: {count} times used." for strategy, count in strategy_counts.items()])
+
+
+def _therapist_turn_complete(text: str) -> bool:
+    """
+    True once the streamed therapist turn contains a finished "**Strategies:**" line,
+    which is always the last part of the turn.
+    """
+    _, marker, strategies = text.partition("**Strategies:**")
+    return bool(marker) and "\n" in strategies
+
+
+def build_therapist_request(state: DialogueState) -> Dict[str, Any]:
+    """
+    Returns the call_llm arguments for the therapist's next turn, using a
+    summarized profile and the static instructions to save tokens.
+    The static instructions are the system message; the patient summary,
+    transcript and strategy usage make up the user message.
+    """
+    # The summary is fixed for the dialogue and the transcript only grows, so
+    # they lead the user message and extend the cached prefix turn by turn
+    therapist_prompt = f"""PATIENT SUMMARY:
+{state["patient_profile_summary"]}
 
 CONVERSATION SO FAR:
-{history_text}
-"""
+{state["history_text"]}
 
-    therapist_instructions = therapist_instructions_template.format(
-        user_analysis=state["patient_profile_summary"],
-        history_text=history_text,
-        strategy_usage=strategy_usage_text,
-        MI_STRATEGIES=get_strategy_names(MI_STRATEGIES),
-        CBT_STRATEGIES=get_strategy_names(CBT_STRATEGIES),
-        ACTIONABLE_TOOLS=get_strategy_names(ACTIONABLE_TOOLS),
-    )
+STRATEGY USAGE:
+{state["strategy_usage_text"]}
 
-    # The user prompt is now just a trigger to generate the response based on the system prompt.
-    therapist_prompt = "Therapist:"
+Therapist:"""
+
+    return {
+        "model": MODEL_THERAPIST,
+        "instructions": THERAPIST_STATIC_INSTRUCTIONS,
+        "input_text": therapist_prompt,
+        "max_output_tokens": MAX_TOKENS_THERAPIST_TURN,
+        "prompt_cache_key": f"therapist-{dialogue_cache_key(state['patient_profile'])}",
+    }
 
-    full_response = call_llm(
-        model=MODEL_THERAPIST,
-        instructions=therapist_instructions,
-        input_text=therapist_prompt,
-        max_output_tokens=512,
-    )
 
+# The "**Strategies:**" marker and the rest of its line. Only that line is taken:
+# the last streamed chunk (or a batch response that runs on) may continue past it.
+STRATEGIES_RE = re.compile(r"\*\*Strategies:\*\*[ \t]*([^\n]*)")
+
+
+def apply_therapist_response(state: DialogueState, full_response: str) -> Dict[str, Any]:
+    """
+    Splits the therapist's response into the reply and the strategies used,
+    and returns the state update.
+    """
     # Parse the response to separate the dialogue from the strategies
-    if "**Strategies:**" in full_response:
-        parts = full_response.split("**Strategies:**")
-        therapist_reply = parts[0].strip()
-        strategies_used_str = parts[1].strip()
-        strategies_used = [s.strip() for s in strategies_used_str.split(",")]
+    match = STRATEGIES_RE.search(full_response)
+    if match:
+        therapist_reply = full_response[:match.start()].strip()
+        strategies_used = [s.strip() for s in match.group(1).split(",") if s.strip()]
     else:
         therapist_reply = full_response.strip()
         strategies_used = []
@@ -621,14 +1441,63 @@ CONVERSATION SO FAR:
     new_turn_index = state["turn_index"] + 1
     new_strategy_history = state["strategy_history"] + strategies_used
 
+    # Track strategy usage incrementally rather than recounting the whole history
+    new_strategy_counts = state["strategy_counts"]
+    new_strategy_usage_text = state["strategy_usage_text"]
+    if strategies_used:
+        new_strategy_counts = new_strategy_counts.copy()
+        new_strategy_counts.update(strategies_used)
+        new_strategy_usage_text = format_strategy_usage(new_strategy_counts)
+
     return {
         "history": new_history,
+        **extend_history_text(state, "therapist", therapist_reply),
         "turn_index": new_turn_index,
         "strategy_history": new_strategy_history,
+        "strategy_counts": new_strategy_counts,
+        "strategy_usage_text": new_strategy_usage_text,
     }
 
 
-# Graph Routing and Construction
+async def therapist_node(state: DialogueState) -> Dict[str, Any]:
+    """
+    Generates the therapist's response, compacting the transcript alongside
+    if it has grown past HISTORY_TOKEN_BUDGET. With SEMANTIC_CACHE=1, a stored
+    reply is reused when the last THERAPIST_CACHE_TURNS messages closely match
+    an earlier exchange.
+    With USE_CONVERSATION_STATE, a therapist chain that is already under way
+    only receives the patient's latest message and the strategy usage.
+    """
+    if not USE_CONVERSATION_STATE:
+        compaction, full_response = await asyncio.gather(
+            summarize_older_turns(state),
+            call_llm(
+                **build_therapist_request(state),
+                stream_until=_therapist_turn_complete,
+                semantic_cache=True,
+                semantic_text=render_history_for_prompt(state["history"][-THERAPIST_CACHE_TURNS:]),
+                semantic_threshold=THERAPIST_CACHE_THRESHOLD,
+            ),
+        )
+        return apply_compaction(apply_therapist_response(state, full_response), compaction)
+
+    request = build_therapist_request(state)
+    previous_response_id = state["therapist_response_id"]
+    if previous_response_id is not None:
+        request["input_text"] = f"""Patient: {state["history"][-1]["content"]}
+
+STRATEGY USAGE:
+{state["strategy_usage_text"]}
+
+Therapist:"""
+    full_response, response_id = await call_llm_chained(previous_response_id=previous_response_id, **request)
+    return {**apply_therapist_response(state, full_response), "therapist_response_id": response_id}
+
+
+# Dialogue Routing and Loop
+
+# Returned by the route functions when the dialogue is over
+END = "end"
 
 
 def route_after_patient(state: DialogueState) -> str:
@@ -647,33 +1516,25 @@ def route_after_therapist(state: DialogueState) -> str:
     return "patient"
 
 
-# Build Graph
-graph = StateGraph(DialogueState)
-
-graph.add_node("patient", patient_node)
-graph.add_node("therapist", therapist_node)
-
-graph.set_entry_point("patient")
-
-graph.add_conditional_edges(
-    "patient",
-    route_after_patient,
-    {
-        "therapist": "therapist",
-        END: END,
-    },
-)
+# Each node's function and the route that picks the node after it
+DIALOGUE_NODES = {
+    "patient": (patient_node, route_after_patient),
+    "therapist": (therapist_node, route_after_therapist),
+}
 
-graph.add_conditional_edges(
-    "therapist",
-    route_after_therapist,
-    {
-        "patient": "patient",
-        END: END,
-    },
-)
 
-app = graph.compile()
+async def run_dialogue(state: DialogueState) -> DialogueState:
+    """
+    Runs a dialogue to completion: the patient opens, then each node's update
+    is merged into the state and its route picks the next node until END.
+    The dialogue is a fixed alternation, so a plain loop drives it.
+    """
+    node = "patient"
+    while node != END:
+        node_fn, route = DIALOGUE_NODES[node]
+        state = {**state, **await node_fn(state)}
+        node = route(state)
+    return state
 
 # Execution and Output
 # Example Conversation Generation
@@ -705,26 +1566,408 @@ example_patient_profile = f"""
 
 difficulty_setting = "hard"
 
-# Generate a concise summary of the patient profile to save tokens
-print("Summarizing patient profile...")
-patient_profile_summary = summarize_patient_profile(example_patient_profile.strip())
-print("Summary complete.")
-
-initial_state: DialogueState = {
-    "history": [],  # empty: patient will start
-    "patient_profile": example_patient_profile.strip(),
-    "patient_profile_summary": patient_profile_summary,
-    "difficulty": difficulty_setting,
-    "difficulty_description": DIFFICULTY_DESCRIPTIONS[difficulty_setting],
-    "max_turns": 60,
-    "turn_index": 0,
-    "strategy_history": [],
-    "patient_resolution_status": False,
-    "patient_state_summary": "",
-}
+# Profiles to simulate; each gets its own dialogue and output file
+patient_profiles = [example_patient_profile.strip()]
+
+
+def build_initial_state(patient_profile: str, patient_profile_summary: str, difficulty: str) -> DialogueState:
+    """Returns the state a dialogue starts from; the patient speaks first."""
+    return {
+        "history": [],  # empty: patient will start
+        "history_text": render_history_for_prompt([]),
+        "history_tokens": 0,
+        "history_summary": "",
+        "summarized_turns": 0,
+        "patient_profile": patient_profile,
+        "patient_profile_summary": patient_profile_summary,
+        "difficulty": difficulty,
+        "patient_model": MODEL_PATIENT,
+        "max_turns": MAX_TURNS,
+        "turn_index": 0,
+        "strategy_history": [],
+        "strategy_counts": Counter(),
+        "strategy_usage_text": format_strategy_usage(Counter()),
+        "patient_resolution_status": False,
+        "patient_state_summary": "",
+        "patient_response_id": None,
+        "therapist_response_id": None,
+    }
+
+
+def dialogue_record(state: DialogueState) -> Dict[str, Any]:
+    """The fields of a finished dialogue that are saved."""
+    return {
+        "patient_profile": state["patient_profile"],
+        "difficulty": state["difficulty"],
+        "patient_model": state["patient_model"],
+        "history": state["history"],
+        "strategy_history": state["strategy_history"],
+    }
+
+
+def has_api_failure(state: DialogueState) -> bool:
+    """True if the profile summary or any turn is the placeholder of a failed API call."""
+    if state["patient_profile_summary"].startswith("[API_FAILURE"):
+        return True
+    return any(msg["content"].startswith("[API_FAILURE") for msg in state["history"])
+
 
-print("Starting simulation...")
-result_state = app.invoke(initial_state, config={"recursion_limit": 200})
+class DialogueStore:
+    """
+    Append-only SQLite store of finished dialogues, one row each, with history
+    and strategy_history as JSON. WAL mode lets the file be read while a run
+    is writing to it. Each dialogue is inserted as soon as it finishes, so a
+    run that stops early keeps what it committed. A dialogue with a failed API
+    call is not saved, so it is regenerated on the next run. Each row keeps the run key of the entry that produced it
+    (see dialogue_run_keys), so a re-run skips the dialogues already saved.
+    """
+
+    def __init__(self, path: str):
+        self.saved = 0
+        self.skipped_failures = 0
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS dialogues ("
+            "id TEXT PRIMARY KEY, created_ns INTEGER NOT NULL, difficulty TEXT NOT NULL, "
+            "patient_model TEXT NOT NULL, patient_profile TEXT NOT NULL, "
+            "history BLOB NOT NULL, strategy_history BLOB NOT NULL, run_key TEXT)"
+        )
+        # Databases written before run keys were stored get the column added
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(dialogues)")}
+        if "run_key" not in columns:
+            self.connection.execute("ALTER TABLE dialogues ADD COLUMN run_key TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS dialogues_run_key ON dialogues (run_key)")
+        self.connection.commit()
+
+    def saved_run_keys(self) -> set:
+        """The run keys of every dialogue already in the store."""
+        rows = self.connection.execute("SELECT run_key FROM dialogues WHERE run_key IS NOT NULL")
+        return {run_key for (run_key,) in rows}
+
+    def add(self, state: DialogueState, run_key: str):
+        """
+        Inserts one finished dialogue with its run key. Rows are committed every
+        DIALOGUE_COMMIT_INTERVAL inserts, and by close for the rest.
+        """
+        # Don't persist API failure placeholders; the entry stays pending instead
+        if has_api_failure(state):
+            logger.warning("Not saving dialogue for %s: it contains a failed API call.", run_key[:12])
+            self.skipped_failures += 1
+            return
+        record = dialogue_record(state)
+        self.connection.execute(
+            "INSERT INTO dialogues VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                uuid.uuid4().hex,
+                time.time_ns(),
+                record["difficulty"],
+                record["patient_model"],
+                record["patient_profile"],
+                orjson.dumps(record["history"]),
+                orjson.dumps(record["strategy_history"]),
+                run_key,
+            ),
+        )
+        self.saved += 1
+        self.uncommitted += 1
+        if self.uncommitted >= DIALOGUE_COMMIT_INTERVAL:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+async def generate_dialogue(
+    patient_profile: str, run_key: str, difficulty: str, store: DialogueStore
+) -> DialogueState:
+    """
+    Summarizes one patient profile, runs its dialogue to completion and saves it to store.
+    At most MAX_CONCURRENT_DIALOGUES dialogues run at once.
+    """
+    # Generate a concise summary of the patient profile to save tokens
+    logger.info("Summarizing patient profile...")
+    patient_profile_summary = await summarize_patient_profile(patient_profile)
+    logger.info("Summary complete.")
+
+    initial_state = build_initial_state(patient_profile, patient_profile_summary, difficulty)
+
+    async with dialogue_semaphore:
+        logger.info("Starting simulation...")
+        state = await run_dialogue(initial_state)
+    store.add(state, run_key)
+    return state
+
+
+async def submit_batch(requests: List[Dict[str, Any]]) -> List[str]:
+    """
+    Submits call_llm-style requests as one Batch API job, polls until it
+    finishes and returns the response texts in request order. Failed requests
+    get the same placeholder call_llm returns on an API error.
+    With USE_EXACT_CACHE set, identical requests are submitted once and share
+    the response; otherwise each is sampled separately, as on the live path.
+    """
+    if USE_EXACT_CACHE:
+        # Index of the first occurrence of each distinct request
+        first_index_by_key = {}
+        source_indices = []
+        for index, request in enumerate(requests):
+            key = ExactResponseCache.request_key(
+                request["model"], request["instructions"], request["input_text"],
+                request["max_output_tokens"], request.get("response_format"),
+            )
+            source_indices.append(first_index_by_key.setdefault(key, index))
+    else:
+        source_indices = list(range(len(requests)))
+    unique_indices = sorted(set(source_indices))
+
+    os.makedirs(os.path.dirname(BATCH_REQUESTS_FILE) or ".", exist_ok=True)
+    with open(BATCH_REQUESTS_FILE, "wb") as batch_file:
+        for index in unique_indices:
+            request = requests[index]
+            body = {
+                "model": request["model"],
+                "messages": [
+                    {"role": "system", "content": request["instructions"]},
+                    {"role": "user", "content": request["input_text"]},
+                ],
+                "max_tokens": fit_output_tokens(
+                    request["instructions"], request["input_text"], request["max_output_tokens"]
+                ),
+            }
+            if request.get("response_format"):
+                body["response_format"] = request["response_format"]
+            if request.get("prompt_cache_key"):
+                body["prompt_cache_key"] = request["prompt_cache_key"]
+            batch_file.write(orjson.dumps({
+                "custom_id": f"request-{index}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            }) + b"\n")
+
+    with open(BATCH_REQUESTS_FILE, "rb") as batch_file:
+        uploaded = await client.files.create(file=batch_file, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    logger.info("Submitted batch %s with %d requests.", batch.id, len(unique_indices))
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await client.batches.retrieve(batch.id)
+        logger.info("Batch %s status: %s", batch.id, batch.status)
+
+    responses = ["[API_FAILURE: BatchError]"] * len(requests)
+    if batch.status != "completed" or not batch.output_file_id:
+        logger.error("Batch %s finished with status '%s'.", batch.id, batch.status)
+        return responses
+
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        index = int(record["custom_id"].split("-")[1])
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            logger.error("Batch request %s failed: %s", record["custom_id"], record.get("error"))
+            continue
+        responses[index] = response["body"]["choices"][0]["message"]["content"].strip()
+    return [responses[source_index] for source_index in source_indices]
+
+
+async def generate_dialogues_batch(
+    profiles: List[str], run_keys: List[str], difficulty: str, store: DialogueStore
+) -> List[DialogueState]:
+    """
+    Generates the dialogues as a breadth-first wavefront through the Batch API:
+    one batch summarizes every profile, then each batch advances every unfinished
+    dialogue by one turn, using the same prompts, parsing and routing as run_dialogue.
+    Each dialogue is saved to store after the batch that finishes it.
+    """
+    logger.info("Summarizing patient profiles...")
+    summaries = await submit_batch([build_summary_request(profile) for profile in profiles])
+    states = [
+        build_initial_state(profile, summary, difficulty)
+        for profile, summary in zip(profiles, summaries)
+    ]
+
+    # Next node for each unfinished dialogue, keyed by its index in `states`
+    pending = {index: "patient" for index in range(len(states))}
+    while pending:
+        indices = list(pending)
+        requests = [
+            build_patient_request(states[index]) if pending[index] == "patient"
+            else build_therapist_request(states[index])
+            for index in indices
+        ]
+        logger.info("Running batch turn for %d dialogues...", len(indices))
+        responses = await submit_batch(requests)
+
+        for index, response_str in zip(indices, responses):
+            state = states[index]
+            if pending[index] == "patient":
+                state = {**state, **apply_patient_response(state, response_str)}
+                next_node = route_after_patient(state)
+            else:
+                state = {**state, **apply_therapist_response(state, response_str)}
+                next_node = route_after_therapist(state)
+            states[index] = state
+            if next_node == END:
+                store.add(state, run_keys[index])
+                del pending[index]
+            else:
+                pending[index] = next_node
+
+    return states
+
+
+class DialogueRunner:
+    """
+    Runs live dialogues as a wavefront: each step sends the next request of
+    every active dialogue at once, with the same nodes and routing as run_dialogue.
+    Up to MAX_CONCURRENT_DIALOGUES dialogues are active; when one ends, it is
+    saved to the store and the next profile is admitted, and its summary is
+    requested in the following step alongside the other dialogues' turns, so
+    the active set stays full. A dialogue whose step raises is logged and dropped.
+    """
+
+    def __init__(self, profiles: List[str], run_keys: List[str], difficulty: str, store: DialogueStore):
+        self.profiles = profiles
+        self.run_keys = run_keys
+        self.difficulty = difficulty
+        self.store = store
+        self.states: List[Optional[DialogueState]] = [None] * len(profiles)
+        self.finished: List[int] = []
+
+    async def _step(self, index: int, node: str) -> str:
+        """Runs one dialogue's next node and returns the node after it."""
+        if node == "summary":
+            summary = await summarize_patient_profile(self.profiles[index])
+            self.states[index] = build_initial_state(self.profiles[index], summary, self.difficulty)
+            return "patient"
+        node_fn, route = DIALOGUE_NODES[node]
+        state = self.states[index]
+        self.states[index] = state = {**state, **await node_fn(state)}
+        return route(state)
+
+    async def run(self) -> List[DialogueState]:
+        """Runs every dialogue and returns those that finished, in profile order."""
+        logger.info("Starting simulation of %d dialogues...", len(self.profiles))
+        next_index = 0
+        # Next node for each active dialogue, keyed by its index in `profiles`
+        active: Dict[int, str] = {}
+        while True:
+            while len(active) < MAX_CONCURRENT_DIALOGUES and next_index < len(self.profiles):
+                active[next_index] = "summary"
+                next_index += 1
+            if not active:
+                return [self.states[index] for index in sorted(self.finished)]
+            indices = list(active)
+            next_nodes = await asyncio.gather(
+                *[self._step(index, active[index]) for index in indices], return_exceptions=True
+            )
+            active = {}
+            for index, node in zip(indices, next_nodes):
+                if isinstance(node, BaseException):
+                    logger.error("Dialogue %d failed: %r", index, node)
+                elif node == END:
+                    self.store.add(self.states[index], self.run_keys[index])
+                    self.finished.append(index)
+                else:
+                    active[index] = node
+
+
+async def warm_up_connections():
+    """
+    Establishes a pooled HTTPS connection with one cheap request, so later
+    requests reuse it instead of each opening its own.
+    """
+    try:
+        await client.models.list()
+    except Exception as e:
+        logger.warning("Connection warm-up failed: %s", e)
+
+
+async def generate_dialogues(
+    profiles: List[str], run_keys: List[str], difficulty: str, store: DialogueStore
+) -> List[DialogueState]:
+    """
+    Generates the dialogues for all profiles concurrently. Each dialogue is a
+    chain of dependent turns, so the speed-up comes from interleaving dialogues
+    while their requests wait on the network.
+    With USE_BATCH_API set, the dialogues run through the Batch API instead;
+    otherwise USE_WAVEFRONT picks DialogueRunner over one run_dialogue per dialogue.
+    A profile listed more than once gets a separately sampled dialogue per entry.
+    Every dialogue is saved to store under its run key as soon as it finishes;
+    the finished dialogues are returned, and one that raises is logged and left out.
+    """
+    if WARM_UP_CONNECTIONS:
+        await warm_up_connections()
+    if USE_BATCH_API:
+        return await generate_dialogues_batch(profiles, run_keys, difficulty, store)
+    if USE_WAVEFRONT:
+        return await DialogueRunner(profiles, run_keys, difficulty, store).run()
+    results = await asyncio.gather(
+        *[generate_dialogue(profile, run_key, difficulty, store) for profile, run_key in zip(profiles, run_keys)],
+        return_exceptions=True,
+    )
+    states = []
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.error("Dialogue %d failed: %r", index, result)
+        else:
+            states.append(result)
+    return states
+
+
+def dialogue_run_keys(profiles: List[str], difficulty: str) -> List[str]:
+    """
+    Returns one run key per profile entry: a SHA-256 of its profile, difficulty,
+    max_turns and replica index. The replica index counts earlier entries of the
+    same profile, so each repeat of a profile is a dialogue of its own.
+    """
+    run_keys = []
+    replicas = Counter()
+    for profile in profiles:
+        entry = {
+            "patient_profile": profile,
+            "difficulty": difficulty,
+            "max_turns": MAX_TURNS,
+            "replica": replicas[profile],
+        }
+        payload = orjson.dumps(entry, option=orjson.OPT_SORT_KEYS)
+        run_keys.append(hashlib.sha256(payload).hexdigest())
+        replicas[profile] += 1
+    return run_keys
+
+
+# Entries whose dialogue an earlier run already saved are skipped
+dialogue_store = DialogueStore(DIALOGUES_DB_FILE)
+run_keys = dialogue_run_keys(patient_profiles, difficulty_setting)
+saved_run_keys = dialogue_store.saved_run_keys()
+pending_entries = [
+    (profile, run_key)
+    for profile, run_key in zip(patient_profiles, run_keys)
+    if run_key not in saved_run_keys
+]
+pending_run_keys = [run_key for _, run_key in pending_entries]
+
+# Closing the store commits the last rows, also when the run is interrupted
+try:
+    result_states = asyncio.run(
+        generate_dialogues(
+            [profile for profile, _ in pending_entries], pending_run_keys, difficulty_setting, dialogue_store
+        )
+    )
+finally:
+    dialogue_store.close()
 
 
 def print_dialogue(history: List[Dict[str, str]]):
@@ -735,40 +1978,46 @@ def print_dialogue(history: List[Dict[str, str]]):
         print(f"{i + 1:02d} {prefix}: {msg['content']}\n")
 
 
-# Display results
-
-# Print the simulated dialogue
-print_dialogue(result_state["history"])
-
-# Print the strategies used
-print("\n--- Strategies Used ---\n")
-if result_state["strategy_history"]:
-    unique_strategies = sorted(list(set(result_state["strategy_history"])))
-    for strategy in unique_strategies:
-        print(f"- {strategy}")
-else:
-    print("No strategies were recorded.")
-
-
-# Set output directory
-output_dir = r"C:\Users\vikto\RecoveryBot Project"
-os.makedirs(output_dir, exist_ok=True)
+if response_cache is not None:
+    response_cache.save()
+logger.info(
+    "Cache hits: %d exact, %d semantic.",
+    exact_cache.hits if exact_cache is not None else 0,
+    response_cache.hits if response_cache is not None else 0,
+)
 
-# Create timestamped filename inside output directory
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-output_filename = f"simulated_dialogue_{timestamp}.json"
-output_path = os.path.join(output_dir, output_filename)
 
-# Prepare data for saving
-output_data = {
-    "patient_profile": result_state["patient_profile"],
-    "difficulty": result_state["difficulty"],
-    "history": result_state["history"],
-    "strategy_history": result_state["strategy_history"],
-}
+for result_state in result_states:
+    # Display results
 
-# Save JSON file
-with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(output_data, f, indent=2)
+    # Print the simulated dialogue
+    print_dialogue(result_state["history"])
 
-print(f"Saved dialogue to {output_path}")
+    # Print the strategies used
+    print("\n--- Strategies Used ---\n")
+    if result_state["strategy_history"]:
+        unique_strategies = sorted(list(set(result_state["strategy_history"])))
+        for strategy in unique_strategies:
+            print(f"- {strategy}")
+    else:
+        print("No strategies were recorded.")
+
+    if DEBUG_PRETTY:
+        # A nanosecond timestamp keeps names unique across dialogues and across runs
+        output_filename = f"simulated_dialogue_{time.time_ns()}.json"
+        output_path = os.path.join(OUTPUT_DIR, output_filename)
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(dialogue_record(result_state), option=orjson.OPT_INDENT_2))
+        logger.info("Saved dialogue to %s", output_path)
+
+logger.info("Saved %d dialogues to %s", dialogue_store.saved, DIALOGUES_DB_FILE)
+if dialogue_store.skipped_failures:
+    logger.warning(
+        "%d dialogues had failed API calls and were not saved; the next run retries them.",
+        dialogue_store.skipped_failures,
+    )
+logger.info(
+    "Stored dialogue hits: %d of %d entries were already saved and skipped.",
+    len(patient_profiles) - len(pending_entries),
+    len(patient_profiles),
+)